@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#Micro-benchmark of the per-publish cost of HomebridgeClass and DomoticzClass messages: the original dict + json.dumps build against the
+#pre-encoded PublishTemplateClass templates. Run from the repository root with the Home Manager's dependencies installed:
+#python Benchmarks/publish_benchmark.py
+import os
+import sys
+import json
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Northcliff_Home_Manager_Gen as home_manager
+
+class NullClient(object): # Stands in for the mqtt client so that only message building is timed
+    def publish(self, topic, payload):
+        pass
+
+home_manager.client = NullClient()
+enviro_config = {'Indoor': {'mqtt Topic': 'Indoor EM1', 'Capture Non AQI': True, 'Homebridge Display': True,
+                            'Device IDs': {'P1': 789, 'P2.5': 790, 'P10': 791, 'AQI': 792, 'NH3': 795, 'Oxi': 793, 'Red': 794,
+                                           'Temp': 824, 'Hum': 824, 'Dew': 1062,'Bar': 824, 'Lux':820, 'CO2': 825, 'VOC': 826, 'Noise': 837}}}
+homebridge_data = {'P1': 3.1, 'P2.5': 5.6, 'P10': 7.9, 'Oxi': 23.0, 'Red': 1.71, 'NH3': 0.52, 'CO2': 612.0, 'VOC': 140.0,
+                   'Temp': 21.4, 'Hum': [55.2, '1'], 'Dew': 12.1, 'Lux': 310.5}
+domoticz_data = dict(homebridge_data, Bar=[1013.2, '0'], Noise=42.0)
+individual_aqi = {'P1': 1, 'P2.5': 1, 'P10': 1, 'Oxi': 1, 'Red': 1, 'NH3': 1, 'CO2': 2, 'VOC': 2}
+homebridge = home_manager.HomebridgeClass([], 'Balconies', {}, enviro_config, 12000, 20000, 0)
+homebridge.publish_cache_refresh_interval = 0 # Publish every characteristic, so that the change-only cache doesn't hide the build cost
+# Heartbeat 0 re-sends every idx, so that the send policy doesn't hide the build cost
+domoticz = home_manager.DomoticzClass({'Default': {'Absolute': 0, 'Relative': 0, 'Min Interval': 0, 'Heartbeat': 0}})
+home_manager.homebridge = homebridge
+home_manager.domoticz = domoticz
+
+def original_homebridge_publish(value):
+    homebridge_json = {}
+    homebridge_json['name'] = 'Indoor' + homebridge.enviro_temp_format['name']
+    homebridge_json['service_name'] = 'Indoor' + homebridge.enviro_temp_format['service_name']
+    homebridge_json['characteristic'] = 'CurrentTemperature'
+    homebridge_json['value'] = value
+    home_manager.client.publish(homebridge.outgoing_mqtt_topic, json.dumps(homebridge_json))
+
+def original_domoticz_publish(value):
+    domoticz_json = {}
+    domoticz_json['idx'] = 790
+    domoticz_json['nvalue'] = 0
+    domoticz_json['svalue'] = str(value)
+    home_manager.client.publish(domoticz.outgoing_mqtt_topic, json.dumps(domoticz_json))
+
+homebridge_template = home_manager.PublishTemplateClass((('name', 'Indoor Env Temp'), ('service_name', 'Indoor Env Temp'),
+                                                        ('characteristic', 'CurrentTemperature')), ('value',))
+
+def template_homebridge_publish(value):
+    home_manager.client.publish(homebridge.outgoing_mqtt_topic, homebridge_template.render(value))
+
+def report(label, statement, publishes_per_call, number):
+    best = min(timeit.repeat(statement, number=number, repeat=5))
+    print(f'{label:<52} {best / (number * publishes_per_call) * 1e6:8.2f} us/publish')
+
+if __name__ == '__main__':
+    number = 20000
+    print('Single message')
+    report('Homebridge: original dict + json.dumps', lambda: original_homebridge_publish(21.4), 1, number)
+    report('Homebridge: PublishTemplateClass.render', lambda: template_homebridge_publish(21.4), 1, number)
+    report('Homebridge: publish_if_changed (cache + template)',
+           lambda: homebridge.publish_if_changed('Indoor Env Temp', 'Indoor Env Temp', 'CurrentTemperature', 21.4), 1, number)
+    report('Domoticz: original dict + json.dumps', lambda: original_domoticz_publish(5.6), 1, number)
+    report('Domoticz: DomoticzClass.publish', lambda: domoticz.publish(790, 0, '5.6'), 1, number)
+    print('Full Enviro message')
+    report('HomebridgeClass.update_enviro_aqi (17 publishes)',
+           lambda: homebridge.update_enviro_aqi('Indoor', enviro_config['Indoor'], 2, homebridge_data, individual_aqi, 35, True, 900, 1000), 17, number // 10)
+    report('DomoticzClass.update_enviro_aqi (13 publishes)',
+           lambda: domoticz.update_enviro_aqi('Indoor', enviro_config['Indoor'], 2, domoticz_data), 13, number // 10)
@@ -6,20 +6,33 @@ from datetime import datetime, date, timedelta
 import json
 import requests
 import base64
+import hashlib
 import asyncio
 import aiohttp
 from luftdaten import Luftdaten
 from astral import LocationInfo
 from astral.sun import sun
 import caldav
+from caldav.elements import dav
+from caldav.elements.base import BaseElement
 import pytz
 import vobject
 import re
+from email.utils import parsedate_to_datetime
+import math
+import statistics
 from requests.utils import requote_uri
 import traceback
+import os
+import threading
+import concurrent.futures
+import queue
+from collections import OrderedDict, deque
+from array import array
+from bisect import bisect_right
 
 class NorthcliffHomeManagerClass(object):
-    def __init__(self, key_state_log_file_name, watchdog_file_name, luftdaten_sensor_id):
+    def __init__(self, key_state_log_file_name, watchdog_file_name, luftdaten_sensor_ids):
         #print ('Instantiated Home Manager')
         self.key_state_log_file_name = key_state_log_file_name
         self.watchdog_file_name = watchdog_file_name
@@ -47,20 +60,25 @@ class NorthcliffHomeManagerClass(object):
         self.domoticz_incoming_mqtt_topic = 'domoticz/out'
         self.garage_door_incoming_mqtt_topic = 'GarageStatus'
         self.aquarium_monitor_incoming_mqtt_topic = 'AquaTempHB'
-        self.shelly_power_0_incoming_mqtt_topic = 'shellies/shellyem3-485519D6A0A5/emeter/0/power'
-        self.shelly_energy_0_incoming_mqtt_topic = 'shellies/shellyem3-485519D6A0A5/emeter/0/total'
-        self.shelly_power_1_incoming_mqtt_topic = 'shellies/shellyem3-485519D6A0A5/emeter/1/power'
-        self.shelly_energy_1_incoming_mqtt_topic = 'shellies/shellyem3-485519D6A0A5/emeter/1/total'
-        self.shelly_power_2_incoming_mqtt_topic = 'shellies/shellyem3-485519D6A0A5/emeter/2/power'
-        self.shelly_energy_2_incoming_mqtt_topic = 'shellies/shellyem3-485519D6A0A5/emeter/2/total'
+        self.shelly_incoming_mqtt_topic = 'shellies/+/emeter/+/+' # Every channel of every Shelly EM/3EM: shellies/<device id>/emeter/<channel>/<reading>
+        # Shelly channels are grouped into circuits, each sent to its own Domoticz idx every shelly_emit_interval seconds. A circuit's
+        # 'Channels' are (device id, channel) pairs, or 'All' for every channel that reports. A circuit is first sent once each of its
+        # channels has reported its energy total, so that Domoticz never sees a partial total jump. For an 'All' circuit, that's once
+        # its 'Expected Channels' have been found or, without one, once no new channel has been found for shelly_emit_interval seconds.
+        # A channel whose power hasn't been reported for shelly_channel_timeout seconds is left out of its circuits' power until it
+        # reports again. Its energy total is kept
+        self.shelly_circuits = {'Total': {'Channels': 'All', 'Expected Channels': 3, 'idx': 1121}} # One Shelly 3EM
+        self.shelly_emit_interval = 60
+        self.shelly_channel_timeout = 300
+        self.energy_cost_idx = None # Domoticz Custom Sensor idx for today's electricity cost. None if unused
         self.window_blind_light_sensor = 'South Balcony' # Set name of Light Sensor that controls blind. '' if unused.
         self.window_blind_threshold_1 = 12000
         self.window_blind_threshold_2 = 20000
         self.previous_window_blind_state = 0
         heartbeat_check_start_time = time.time()
         enviro_capture_time = heartbeat_check_start_time
-        self.luftdaten_sensor_id = luftdaten_sensor_id
-        self.enviro_config = {'Outdoor': {'mqtt Topic': 'Outdoor EM0', 'Capture Non AQI': True, 'Homebridge Display': True, 'Wind': 'East', 'Capture Time': enviro_capture_time, 'Luftdaten Sensor ID': self.luftdaten_sensor_id,
+        self.luftdaten_sensor_ids = luftdaten_sensor_ids # Nearby Luftdaten stations for the Outdoor Enviro Monitor fallback
+        self.enviro_config = {'Outdoor': {'mqtt Topic': 'Outdoor EM0', 'Capture Non AQI': True, 'Homebridge Display': True, 'Wind': 'East', 'Capture Time': enviro_capture_time, 'Luftdaten Sensor IDs': self.luftdaten_sensor_ids,
                                           'Device IDs': {'P1': 784, 'P2.5': 778, 'P10': 779, 'AQI': 780, 'NH3': 781, 'Oxi': 782, 'Red': 783,
                                                           'Temp': 819, 'Hum': 819, 'Dew': 1063, 'Bar': 819, 'Lux':821, 'Noise': 838, 'Wind': 912}},
                               'Indoor': {'mqtt Topic': 'Indoor EM1', 'Capture Non AQI': True, 'Homebridge Display': True,
@@ -69,14 +87,60 @@ class NorthcliffHomeManagerClass(object):
                               'Front Outdoor': {'mqtt Topic': 'Outdoor EM012', 'Capture Non AQI': True, 'Homebridge Display': False, 'Wind': 'West',
                                           'Device IDs': {'P1': 909, 'P2.5': 908, 'P10': 907, 'AQI': 906, 'NH3': 905, 'Oxi': 904, 'Red': 903,
                                                           'Temp': 899, 'Hum': 899, 'Dew': 1061, 'Bar': 899, 'Lux':901, 'Noise': 902, 'Wind': 912}}}
+        # HomeKit's CO2 peak level is the peak over the last enviro_CO2_peak_window seconds. The recent peaks are kept in the key state
+        # log, at most once per enviro_CO2_peak_log_interval seconds
+        self.enviro_CO2_peak_window = 24 * 3600
+        self.enviro_CO2_peak_log_interval = 900
         self.enable_outdoor_enviro_monitor_luftdaten_backup = True # Enable Luftdaten readings if no PM readings from outdoor Enviro Monitor
-        self.enviro_wind_config = {'Front Outdoor': {'Air Pressure': None, 'Direction': 'West', 'Offset': 0.0}, 'Outdoor': {'Air Pressure': None, 'Direction': 'East', 'Offset': -0.25}}
-        self.enviro_wind_distance = 23 #The distance between enviro air pressure sources in metres
-        self.previous_enviro_wind_source = None #To ensure that alternate enviro sources are used to measure wind speed
+        # The Luftdaten stations are queried together. Their median is used as soon as luftdaten_quorum stations have answered, or with
+        # whichever stations have answered once luftdaten_timeout has passed. A failing station is skipped for luftdaten_backoff seconds,
+        # doubling with each consecutive failure up to luftdaten_max_backoff seconds
+        self.luftdaten_timeout = 20 # Seconds before a Luftdaten request is abandoned
+        self.luftdaten_retry_interval = 900 # Minimum seconds between Luftdaten requests while the Outdoor Enviro Monitor is silent
+        # Seconds that a station's last good response can stand in for it when it fails or misses the deadline. Healthy stations are
+        # always queried, so this must outlast one retry interval for a failed station's response from the previous request to count
+        self.luftdaten_cache_ttl = 2 * self.luftdaten_retry_interval
+        self.luftdaten_quorum = 2
+        self.luftdaten_backoff = 900
+        self.luftdaten_max_backoff = 6 * 3600
+        self.luftdaten_client = LuftdatenClientClass(self.luftdaten_timeout, self.luftdaten_cache_ttl, self.luftdaten_quorum,
+                                                     self.luftdaten_backoff, self.luftdaten_max_backoff)
+        # Domoticz send policy for each Enviro measurement type in 'Device IDs'. A reading is only re-sent when it has moved by more than
+        # max('Absolute', 'Relative' * previous value), and then no more often than 'Min Interval' seconds. Every idx is re-sent at least
+        # every 'Heartbeat' seconds so that Domoticz doesn't flag it as timed out. Measurement types that aren't listed use 'Default'
+        self.domoticz_send_policies = {'Default': {'Absolute': 0, 'Relative': 0, 'Min Interval': 0, 'Heartbeat': 900},
+                                       'P1': {'Absolute': 1, 'Relative': 0.05, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'P2.5': {'Absolute': 1, 'Relative': 0.05, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'P10': {'Absolute': 1, 'Relative': 0.05, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'NH3': {'Absolute': 0, 'Relative': 0.05, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'Oxi': {'Absolute': 0, 'Relative': 0.05, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'Red': {'Absolute': 0, 'Relative': 0.05, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'CO2': {'Absolute': 20, 'Relative': 0, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'VOC': {'Absolute': 10, 'Relative': 0.05, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'AQI': {'Absolute': 0, 'Relative': 0, 'Min Interval': 0, 'Heartbeat': 900},
+                                       'Temp': {'Absolute': 0.2, 'Relative': 0, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'Hum': {'Absolute': 1, 'Relative': 0, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'Bar': {'Absolute': 0.3, 'Relative': 0, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'Dew': {'Absolute': 0.2, 'Relative': 0, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'Lux': {'Absolute': 1, 'Relative': 0.1, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'Noise': {'Absolute': 1, 'Relative': 0.05, 'Min Interval': 60, 'Heartbeat': 900},
+                                       'Wind': {'Absolute': 0.5, 'Relative': 0, 'Min Interval': 60, 'Heartbeat': 900}}
+        # Wind is estimated from the air pressure gradient across any number of Enviro Monitors (at least two, not all in a line for a
+        # true 2-D bearing). Each source's 'Position' is in metres as (East, North) from any common origin and its 'Offset' (hPa) corrects
+        # its barometer. Readings older than 'Max Age Seconds' aren't used. Mean wind and gust are taken over the wind readings in the
+        # last 'Window Seconds'. Readings less than 'Sample Interval' seconds after the last one in the window aren't added to it, so
+        # that the window isn't dominated by bursts of messages
+        self.enviro_wind_config = {'Sources': {'Front Outdoor': {'Position': (0, 0), 'Offset': 0.0},
+                                               'Outdoor': {'Position': (23, 0), 'Offset': -0.25}},
+                                   'Max Age Seconds': 900, 'Window Seconds': 600, 'Sample Interval': 0}
         self.latest_wind = None #Most recent locally-measured wind for the TRMNL display
-        self.enviro_wind_results = [None for x in range(10)] # Set up historical wind_data
+        self.sensor_history = TimeSeriesStoreClass() # Recent history and rollups of every sensor reading, for trends and min/max
+        self.wind_engine = WindEngineClass(self.enviro_wind_config)
         self.watchdog_update_time = 0
         self.trmnl_update_time = 0
+        self.previous_luftdaten_capture_time = 0
+        self.event_loop = None # The main asyncio loop, set once run_scheduler() starts
+        self.blind_trigger_events = {} # Blind -> asyncio.Event that wakes its blind trigger handler
         # ---- Window blind automation (used when window_blinds_present is True) ----
         self.powerview_hub_ip = '<Your PowerView Gen 2 Hub IP Address>' # PowerView Gen 2 hub for blind scene control
         self.window_blind_config = {'Living Room Blinds': {'light sensor': 'South Balcony', 'temp sensor': 'North Balcony',
@@ -89,10 +153,25 @@ class NorthcliffHomeManagerClass(object):
                                     'scenes': {'Open': 'Living Open', 'Venetian': 'Living View', 'Closed': 'Living Close',
                                                'Windows Venetian': 'Living Windows View', 'Windows Closed': 'Living Windows Close'}}}
         self.blind_light_sensor_names = [self.window_blind_config[b]['light sensor'] for b in self.window_blind_config]
-        self.call_room_sunlight_control = {'State': False, 'Blind': '', 'Light Level': 100}
-        self.call_control_blinds = {'State': False, 'Blind': '', 'Blind_position': ''}
-        self.auto_blind_override_changed = {'Changed': False, 'Blind': '', 'State': False}
-        self.blind_control_door_changed = {'State': False, 'Blind': '', 'Changed': False}
+        # Pending blind triggers for each blind: 'Light Level', 'Door Changed', 'Auto Override' and 'Manual' (see BlindTriggerQueueClass)
+        self.blind_trigger_queues = {blind: BlindTriggerQueueClass(blind) for blind in self.window_blind_config}
+        # mqtt topic router, compiled by build_topic_router() whenever the subscriptions are (re)made in on_connect
+        self.topic_routes = {} # Exact topic -> (handler, payload decoder, worker lane)
+        self.wildcard_topic_routes = [] # [(subscription pattern, (handler, payload decoder, worker lane))]
+        self.subscribed_topics = []
+        # Messages are handled off the paho network thread by one worker per lane (see MessagePipelineClass)
+        self.message_lanes = ('Homebridge', 'Domoticz Sorter', 'Domoticz', 'Domoticz Events', 'Controllers', 'Shelly', 'Enviro')
+        self.message_queue_bound = 100 # Maximum number of unhandled messages held per lane before the oldest is dropped
+        # These lanes grow rather than drop a message: all of domoticz/out, until it's sorted by device, and door and flood state changes
+        self.lossless_message_lanes = ('Domoticz Sorter', 'Domoticz Events')
+        self.message_stats_interval = 3600 # Seconds between prints of the message lane and Homebridge outbox depths and latencies
+        # Key state changes are written behind: changes within key_state_write_window seconds are merged and appended to a journal,
+        # which is compacted into the key state log snapshot every key_state_compaction_records records
+        self.key_state_write_window = 30
+        self.key_state_compaction_records = 200
+        self.key_state_journal_generations = 3 # Number of compacted journals kept as history
+        self.key_state_persister = KeyStatePersisterClass(self.key_state_log_file_name, self.key_state_write_window, self.build_key_states,
+                                                          self.key_state_compaction_records, self.key_state_journal_generations)
                                
     def on_connect(self, client, userdata, flags, reason_code, properties):
         # Sets up the mqtt subscriptions. Subscribing in on_connect() means that if we lose the connection and reconnect then subscriptions will be renewed.
@@ -100,62 +179,79 @@ class NorthcliffHomeManagerClass(object):
             self.print_update('Northcliff Home Manager Connected to mqtt Broker')
             print('')
             time.sleep(1)
-            client.subscribe(self.homebridge_incoming_mqtt_topic) #Subscribe to Homebridge status for interworking with Apple Home
-            client.subscribe(self.domoticz_incoming_mqtt_topic) # Subscribe to Domoticz for access to its devices
-            if self.garage_door_present:
-                client.subscribe(self.garage_door_incoming_mqtt_topic) # Subscribe to the Garage Door Controller
-            if self.aquarium_monitor_present:
-                client.subscribe(self.aquarium_monitor_incoming_mqtt_topic) # Subscribe to the Aquarium Monitor Heatbeat
-            if self.shelly_power_monitor_present: # Subscribe to relevant Shelly messages if enabled
-                client.subscribe(self.shelly_power_0_incoming_mqtt_topic)
-                client.subscribe(self.shelly_energy_0_incoming_mqtt_topic)
-                client.subscribe(self.shelly_power_1_incoming_mqtt_topic)
-                client.subscribe(self.shelly_energy_1_incoming_mqtt_topic)
-                client.subscribe(self.shelly_power_2_incoming_mqtt_topic)
-                client.subscribe(self.shelly_energy_2_incoming_mqtt_topic)
-            if self.enviro_monitors_present:
-                for enviro_name in self.enviro_config:
-                    client.subscribe(self.enviro_config[enviro_name]['mqtt Topic']) # Subscribe to the Enviro Monitors
+            self.build_topic_router() # Recompile the router so it always matches the subscriptions made below
+            for topic in self.subscribed_topics:
+                client.subscribe(topic)
+            homebridge.resend_cached_values() # Homebridge may have missed updates while we were disconnected
         else:
            self.print_update('Error: Not Connected to mqtt Broker. Reason: ' + str(reason_code)) 
                 
-    def on_message(self, client, userdata, msg):
-        # Calls the relevant methods for the Home Manager, based on the mqtt publish messages received from the doorbell monitor, the homebridge buttons,
-        # Domoticz, the aircon controller and the garage door controller
-        decoded_payload = str(msg.payload.decode("utf-8"))
-        #print (msg.topic)
-        if 'shellies' not in msg.topic: # Shelly doesn't have a json payload
-            parsed_json = json.loads(decoded_payload)
-        #print(msg.topic, parsed_json)
-        if msg.topic == self.homebridge_incoming_mqtt_topic: # If it's a homebridge status message
-            homebridge.capture_homebridge_buttons(parsed_json) # Capture the homebridge button
-        elif msg.topic == self.domoticz_incoming_mqtt_topic: # If coming from domoticz
-            domoticz.process_device_data(parsed_json) # Process the domoticz device data
-        elif msg.topic == self.garage_door_incoming_mqtt_topic: # If coming from the Garage Door Controller
-            garage_door.capture_status(parsed_json) # Capture garage door status
-        elif msg.topic == self.aquarium_monitor_incoming_mqtt_topic:
-            aquarium.capture_aquarium_heartbeat(parsed_json)
-        elif msg.topic == self.shelly_power_0_incoming_mqtt_topic or msg.topic == self.shelly_energy_0_incoming_mqtt_topic or msg.topic == self.shelly_power_1_incoming_mqtt_topic or msg.topic == self.shelly_energy_1_incoming_mqtt_topic or msg.topic == self.shelly_power_2_incoming_mqtt_topic or msg.topic == self.shelly_energy_2_incoming_mqtt_topic:
-            #print ('Shelly Message Found', decoded_payload)
-            shelly.process_reading(msg.topic, decoded_payload) # Process and send Shelly readings
-        else: # Test for enviro
-            identified_message = False
+    def build_topic_router(self):
+        # Compiles each subscribed topic to a (handler, payload decoder, worker lane) route so that on_message does one dict lookup per message,
+        # however many Enviro Monitors, Shelly channels or devices are configured. Handlers are called as handler(topic, decoded_payload)
+        routes = {}
+        routes[self.homebridge_incoming_mqtt_topic] = (lambda topic, parsed_json: homebridge.capture_homebridge_buttons(parsed_json), self.decode_json_payload, 'Homebridge')
+        # Domoticz messages are sorted by device on their own lane, which only decodes them and queues them again for their device's lane
+        routes[self.domoticz_incoming_mqtt_topic] = (lambda topic, parsed_json: domoticz.dispatch_device_message(topic, parsed_json), self.decode_json_payload, 'Domoticz Sorter')
+        if self.garage_door_present:
+            routes[self.garage_door_incoming_mqtt_topic] = (lambda topic, parsed_json: garage_door.capture_status(parsed_json), self.decode_json_payload, 'Controllers')
+        if self.aquarium_monitor_present:
+            routes[self.aquarium_monitor_incoming_mqtt_topic] = (lambda topic, parsed_json: aquarium.capture_aquarium_heartbeat(parsed_json), self.decode_json_payload, 'Controllers')
+        if self.shelly_power_monitor_present: # Shelly doesn't have a json payload
+            routes[self.shelly_incoming_mqtt_topic] = (lambda topic, decoded_payload: shelly.process_reading(topic, decoded_payload), self.decode_text_payload, 'Shelly')
+        if self.enviro_monitors_present:
             for enviro_name in self.enviro_config:
-                if msg.topic == self.enviro_config[enviro_name]['mqtt Topic']: # If coming from an Enviro Monitor
-                    #self.print_update(enviro_name +  ' Northcliff Enviro Monitor Data:' + str(parsed_json) + ' on ')
-                    if enviro_name == 'Outdoor':
-                        self.enviro_config[enviro_name]['Capture Time'] = time.time()
-                    identified_message = True
-                    enviro_monitor[enviro_name].capture_readings('Enviro', parsed_json) # Capture enviro readings
-            if not identified_message: # If the mqtt topic is unknown
-                print ('Unknown mqtt message received', msg.topic)
+                routes[self.enviro_config[enviro_name]['mqtt Topic']] = (lambda topic, parsed_json, enviro_name=enviro_name: self.capture_enviro_message(enviro_name, parsed_json),
+                                                                         self.decode_json_payload, 'Enviro')
+        # Split wildcard subscriptions from exact topics. Topics that match a wildcard are added to topic_routes on first sight
+        self.wildcard_topic_routes = [(pattern, routes[pattern]) for pattern in routes if '+' in pattern or '#' in pattern]
+        self.topic_routes = {topic: routes[topic] for topic in routes if not ('+' in topic or '#' in topic)}
+        self.subscribed_topics = list(routes)
+
+    def resolve_topic_route(self, topic):
+        route = self.topic_routes.get(topic)
+        if route is None:
+            for pattern, wildcard_route in self.wildcard_topic_routes:
+                if mqtt.topic_matches_sub(pattern, topic):
+                    route = wildcard_route
+                    self.topic_routes[topic] = route # Cache so the next message on this topic is a single lookup
+                    break
+        return route
+
+    def decode_json_payload(self, payload):
+        return json.loads(payload.decode("utf-8"))
+
+    def decode_text_payload(self, payload):
+        return str(payload.decode("utf-8"))
+
+    def decode_decoded_payload(self, payload): # For data that's queued already decoded, e.g. Luftdaten data
+        return payload
+
+    def on_message(self, client, userdata, msg):
+        # Queues the mqtt publish messages received from the homebridge buttons, Domoticz, the garage door controller, the aquarium monitor,
+        # the Shelly energy meter and the Enviro Monitors for their worker lane. Nothing is decoded or handled on the paho network thread
+        route = self.resolve_topic_route(msg.topic)
+        if route is None: # Reject unknown topics before decoding their payload
+            print ('Unknown mqtt message received', msg.topic)
+            return
+        handler, decoder, lane = route
+        pipeline.enqueue(lane, msg.topic, handler, decoder, msg.payload)
+
+    def capture_enviro_message(self, enviro_name, parsed_json):
+        #self.print_update(enviro_name +  ' Northcliff Enviro Monitor Data:' + str(parsed_json) + ' on ')
+        if enviro_name == 'Outdoor':
+            self.enviro_config[enviro_name]['Capture Time'] = time.time()
+        enviro_monitor[enviro_name].capture_readings('Enviro', parsed_json) # Capture enviro readings
 
     def print_update(self, print_message): # Prints with a date and time stamp
         today = datetime.now()
         print('')
         print(print_message + today.strftime('%A %d %B %Y @ %H:%M:%S'))
 
-    def log_key_states(self, reason):
+    def log_key_states(self, reason): # Marks the key states as changed. They are written by the key state persister once its write window has passed
+        self.key_state_persister.mark_dirty(reason)
+
+    def build_key_states(self, reason):
         # Log Door, Blind and Powerpoint States
         key_state_log = {}
         key_state_log["Reason"] = reason
@@ -164,8 +260,10 @@ class NorthcliffHomeManagerClass(object):
         if self.enviro_monitors_present:
             for enviro_name in self.enviro_config:
                 if enviro_name == 'Indoor' and 'CO2' in self.enviro_config[enviro_name]['Device IDs']:
-                    key_state_log['Enviro Max CO2'] = enviro_monitor[enviro_name].max_CO2
-                    #print('Wrote Enviro Max CO2 to Log', reason, enviro_name, enviro_monitor[enviro_name].max_CO2)
+                    key_state_log['Enviro CO2 Peaks'] = enviro_monitor[enviro_name].CO2_peak.summary()
+                    #print('Wrote Enviro CO2 Peaks to Log', reason, enviro_name, key_state_log['Enviro CO2 Peaks'])
+        if energy_cost is not None:
+            key_state_log['Energy Cost'] = energy_cost.summary()
         if self.window_blind_light_sensor != '' and self.multisensors_present:
             key_state_log['Window Blind State'] = homebridge.previous_window_blind_state
             key_state_log['Window Blind Light Level'] = multisensor[self.window_blind_light_sensor].sensor_types_with_value['Light Level']
@@ -174,24 +272,24 @@ class NorthcliffHomeManagerClass(object):
             key_state_log['Blind High Temp'] = {b: window_blind[b].window_blind_config['high_temp_threshold'] for b in self.window_blind_config}
             key_state_log['Blind Low Temp'] = {b: window_blind[b].window_blind_config['low_temp_threshold'] for b in self.window_blind_config}
             key_state_log['Blind Auto Override'] = {b: window_blind[b].auto_override for b in self.window_blind_config}
-        with open(self.key_state_log_file_name, 'w') as f:
-            f.write(json.dumps(key_state_log))   
+        return key_state_log
 
     def retrieve_key_states(self):
-        with open(self.key_state_log_file_name, 'r') as f:
-            parsed_key_states = json.loads(f.read())
+        parsed_key_states = self.key_state_persister.load() # The last snapshot with the journal replayed over it
         print('Retrieved Key States', parsed_key_states)
-        print ('Previous logging reason was', parsed_key_states['Reason'])
+        print ('Previous logging reason was', parsed_key_states.get('Reason'))
         if self.door_sensors_present and 'Door State' in parsed_key_states:
             for name in parsed_key_states['Door State']:
                 door_sensor[name].current_door_opened = parsed_key_states['Door State'][name]
                 door_sensor[name].previous_door_opened = parsed_key_states['Door State'][name]
                 homebridge.update_door_state(name, self.door_sensor_names_locations[name], parsed_key_states['Door State'][name], False)
-        if self.enviro_monitors_present and 'Enviro Max CO2' in parsed_key_states:
+        if self.enviro_monitors_present and 'Enviro CO2 Peaks' in parsed_key_states: # Earlier all-time 'Enviro Max CO2' logs aren't carried over
             for enviro_name in self.enviro_config:
                 if enviro_name == 'Indoor' and 'CO2' in self.enviro_config[enviro_name]['Device IDs']:
-                    enviro_monitor[enviro_name].max_CO2 = parsed_key_states['Enviro Max CO2']
-                    #print('Retrieved Enviro Max CO2 from Log', parsed_key_states['Reason'], enviro_name, enviro_monitor[enviro_name].max_CO2)
+                    enviro_monitor[enviro_name].CO2_peak.restore(parsed_key_states['Enviro CO2 Peaks'])
+                    #print('Retrieved Enviro CO2 Peaks from Log', parsed_key_states['Reason'], enviro_name, enviro_monitor[enviro_name].CO2_peak.peak())
+        if energy_cost is not None and 'Energy Cost' in parsed_key_states:
+            energy_cost.restore(parsed_key_states['Energy Cost'])
         if self.window_blind_light_sensor != '' and self.multisensors_present:
             if 'Window Blind State' in parsed_key_states:
                 homebridge.previous_window_blind_state = parsed_key_states['Window Blind State']
@@ -212,6 +310,11 @@ class NorthcliffHomeManagerClass(object):
 
     def shutdown(self, reason):
         self.log_key_states(reason)
+        self.key_state_persister.flush() # Write now rather than waiting for the write window
+        try:
+            self.luftdaten_client.stop()
+        except Exception as e:
+            print('Luftdaten Client close error:', e)
         client.loop_stop() # Stop mqtt monitoring
         self.print_update('Home Manager Shut Down due to ' + reason + ' on ')
       
@@ -230,47 +333,552 @@ class NorthcliffHomeManagerClass(object):
             if self.garage_door_present:
                 homebridge.update_garage_door('Closing')
                 homebridge.update_garage_door('Closed')
-            previous_luftdaten_capture_time = 0 # Initialise luftdaten capture time
-            while True: # The main Home Manager Loop
-                if time.time() - self.watchdog_update_time >= 60: # Write to the watchdog log every minute
-                    with open(self.watchdog_file_name, 'w') as f:
-                        f.write('Home Manager Script Alive')
-                    self.watchdog_update_time = time.time()
-                if self.enviro_monitors_present and self.enable_outdoor_enviro_monitor_luftdaten_backup:
-                    if time.time() - self.enviro_config['Outdoor']['Capture Time'] > 600: # Capture Luftdaten Air Quality if the Outdoor Enviro Monitor is unavailable
-                        if time.time() - previous_luftdaten_capture_time > 900:
-                            print('No message from Outdoor Northcliff Enviro Monitor, using Luftdaten from station', self.enviro_config['Outdoor']['Luftdaten Sensor ID'])
-                            enviro_monitor['Outdoor'].capture_luftdaten_data(self.enviro_config['Outdoor']['Luftdaten Sensor ID'])
-                            previous_luftdaten_capture_time = time.time()
-                if self.trmnl_present:
-                    now = datetime.now()
-                    if now.minute in (1, 16, 31, 46) and time.time() - self.trmnl_update_time >= 120: # Pushes updates one minute past hour and half hour
-                        trmnl.push()
-                        self.trmnl_update_time = time.time()
-                if self.window_blinds_present:
-                    # Blind triggers are actioned here (not in on_message) so their network/sleep calls don't delay mqtt handling
-                    if self.call_room_sunlight_control['State']: # New blind light-sensor reading
-                        blind = self.call_room_sunlight_control['Blind']
-                        window_blind[blind].room_sunlight_control(self.call_room_sunlight_control['Light Level'])
-                        self.call_room_sunlight_control['State'] = False
-                    if self.blind_control_door_changed['Changed']: # A blind-control door changed state
-                        blind = self.blind_control_door_changed['Blind']
-                        light_level = multisensor[self.window_blind_config[blind]['light sensor']].sensor_types_with_value['Light Level']
-                        window_blind[blind].room_sunlight_control(light_level)
-                        self.blind_control_door_changed['Changed'] = False
-                    if self.auto_blind_override_changed['Changed']: # The auto-override switch changed
-                        blind = self.auto_blind_override_changed['Blind']
-                        light_level = multisensor[self.window_blind_config[blind]['light sensor']].sensor_types_with_value['Light Level']
-                        window_blind[blind].room_sunlight_control(light_level)
-                        self.auto_blind_override_changed['Changed'] = False
-                    if self.call_control_blinds['State']: # A manual blind change was invoked
-                        blind = self.call_control_blinds['Blind']
-                        window_blind[blind].control_blinds(self.call_control_blinds['Blind_position'])
-                        self.call_control_blinds['State'] = False
-                time.sleep(1) 
+            asyncio.run(self.run_scheduler()) # The main Home Manager event loop
         except KeyboardInterrupt:
             self.shutdown('Keyboard Interrupt')
 
+    async def run_scheduler(self):
+        # Timers are scheduled deadlines and blind triggers are awaited events, so the loop sleeps until there is something to do
+        self.event_loop = asyncio.get_running_loop()
+        self.blind_trigger_events = {blind: asyncio.Event() for blind in self.blind_trigger_queues}
+        tasks = [self.watchdog_timer()]
+        if self.enviro_monitors_present and self.enable_outdoor_enviro_monitor_luftdaten_backup:
+            tasks.append(self.luftdaten_timer())
+        if self.shelly_power_monitor_present:
+            tasks.append(self.shelly_timer())
+        if self.trmnl_present:
+            tasks.append(self.trmnl_timer())
+        if self.window_blinds_present: # One handler per blind, so each blind's triggers stay in order while blinds don't wait for each other
+            for blind in self.blind_trigger_queues:
+                tasks.append(self.blind_trigger_handler(blind))
+        await asyncio.gather(*tasks)
+
+    def post_blind_trigger(self, blind, cause, value=None): # Queues a blind trigger and wakes its blind trigger handler. Safe to call from any thread
+        self.blind_trigger_queues[blind].post(cause, value)
+        if self.event_loop is not None:
+            self.event_loop.call_soon_threadsafe(self.blind_trigger_events[blind].set)
+
+    async def watchdog_timer(self):
+        stats_time = time.time()
+        while True: # Write to the watchdog log every minute
+            with open(self.watchdog_file_name, 'w') as f:
+                f.write('Home Manager Script Alive')
+            self.watchdog_update_time = time.time()
+            if self.watchdog_update_time - stats_time >= self.message_stats_interval:
+                self.print_message_stats()
+                stats_time = self.watchdog_update_time
+            await asyncio.sleep(60)
+
+    def print_message_stats(self): # Queue depths, drops and latencies (in seconds) of the message lanes and the Homebridge outbox
+        for lane, lane_stats in pipeline.get_stats().items():
+            print('Message lane', lane, lane_stats)
+        print('Ignored Domoticz messages from unmodelled devices:', domoticz.ignored_device_messages)
+        print('Homebridge outbox', homebridge.outbox.get_stats())
+
+    async def luftdaten_timer(self):
+        # Capture Luftdaten Air Quality if the Outdoor Enviro Monitor has been silent for 10 minutes, no more than every luftdaten_retry_interval.
+        # Sleeps until the later of the two deadlines, then re-checks because a new Outdoor message moves the staleness deadline
+        while True:
+            stale_time = self.enviro_config['Outdoor']['Capture Time'] + 600
+            retry_time = self.previous_luftdaten_capture_time + self.luftdaten_retry_interval
+            wait_time = max(stale_time, retry_time) - time.time()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+                continue
+            print('No message from Outdoor Northcliff Enviro Monitor, using Luftdaten from stations', self.enviro_config['Outdoor']['Luftdaten Sensor IDs'])
+            enviro_monitor['Outdoor'].capture_luftdaten_data(self.enviro_config['Outdoor']['Luftdaten Sensor IDs']) # Runs in the background
+            self.previous_luftdaten_capture_time = time.time()
+
+    def next_trmnl_push_time(self, now): # Pushes updates one minute past each quarter hour
+        for minute in (1, 16, 31, 46):
+            push_time = now.replace(minute=minute, second=0, microsecond=0)
+            if push_time > now:
+                return push_time
+        return (now + timedelta(hours=1)).replace(minute=1, second=0, microsecond=0)
+
+    async def shelly_timer(self):
+        while True: # Send the Shelly circuit totals to Domoticz. They're sent from the Shelly lane, in turn with the Shelly readings
+            await asyncio.sleep(self.shelly_emit_interval)
+            pipeline.enqueue('Shelly', 'Shelly Emit', lambda topic, payload: shelly.emit(), self.decode_decoded_payload, None)
+
+    async def trmnl_timer(self):
+        while True:
+            now = datetime.now()
+            await asyncio.sleep((self.next_trmnl_push_time(now) - now).total_seconds())
+            await self.event_loop.run_in_executor(None, trmnl.push) # Gathering and posting block, so they run off the scheduler
+            self.trmnl_update_time = time.time()
+
+    async def blind_trigger_handler(self, blind):
+        # Blind triggers are actioned here (not in the message workers) so their network/sleep calls don't delay mqtt handling. The actions
+        # make blocking PowerView calls, so they run off the scheduler, one batch at a time so that this blind's triggers stay in order
+        while True:
+            self.blind_trigger_events[blind].clear() # Cleared before the queue is taken so that a trigger posted while it's being actioned isn't missed
+            triggers = self.blind_trigger_queues[blind].take_all()
+            if triggers:
+                await self.event_loop.run_in_executor(None, self.action_blind_triggers, blind, triggers)
+            await self.blind_trigger_events[blind].wait()
+
+    def action_blind_triggers(self, blind, triggers):
+        for cause, value in triggers: # Each distinct cause is actioned once, in arrival order
+            try:
+                if cause == 'Manual': # A manual blind change was invoked
+                    window_blind[blind].control_blinds(value)
+                elif cause == 'Light Level': # New blind light-sensor reading
+                    window_blind[blind].room_sunlight_control(value)
+                else: # A blind-control door changed state or the auto-override switch changed
+                    light_level = multisensor[self.window_blind_config[blind]['light sensor']].sensor_types_with_value['Light Level']
+                    window_blind[blind].room_sunlight_control(light_level)
+            except Exception:
+                print('Error actioning', cause, 'trigger for', blind)
+                traceback.print_exc()
+
+class KeyStatePersisterClass(object):
+    # Write-behind, journalled persistence for the key state log. A change only marks the state dirty; all changes within the write window
+    # are merged, then appended to the journal as small typed records, one per changed state item (e.g. one door or one blind's status).
+    # Once the journal holds compaction_records records, the full state is written as a new snapshot (atomically: temporary file, fsync,
+    # rename) and the journal is rotated, keeping journal_generations old journals as a replayable history of the state changes.
+    # The snapshot has the same format as the original single-file key state log
+    def __init__(self, file_name, write_window, build_state, compaction_records=200, journal_generations=3):
+        self.file_name = file_name # The snapshot
+        self.journal_file_name = file_name + '.journal'
+        self.write_window = write_window
+        self.build_state = build_state # Called with the merged change reasons and returns the current state dict
+        self.compaction_records = compaction_records
+        self.journal_generations = journal_generations
+        self.lock = threading.Lock()
+        self.persisted_state = None # The state as it stands on disk (snapshot plus journal)
+        self.journal_record_count = 0
+        self.dirty_reasons = []
+        self.timer = None
+        self.write_count = 0
+        self.merged_count = 0
+
+    def load(self): # Rebuilds the state from the last snapshot plus the journal tail
+        with self.lock:
+            state = {}
+            try:
+                with open(self.file_name, 'r') as f:
+                    state = json.loads(f.read())
+            except FileNotFoundError:
+                print('No Key State snapshot found')
+            self.journal_record_count = 0
+            self.repair_journal()
+            for record in self.read_journal(self.journal_file_name):
+                self.apply_record(state, record)
+                self.journal_record_count += 1
+            self.persisted_state = state
+            return json.loads(json.dumps(state)) # A copy, so the caller can't alter the persisted state
+
+    def repair_journal(self): # Truncates a torn tail from a crash mid-append, so that the next append starts on a fresh line
+        try:
+            with open(self.journal_file_name, 'r+b') as f:
+                good_end = 0
+                offset = 0
+                for line in f:
+                    offset += len(line)
+                    if line.endswith(b'\n'): # Only the final line can be missing its newline
+                        good_end = offset
+                if offset > good_end:
+                    print('Truncating torn Key State journal tail of', offset - good_end, 'bytes')
+                    f.truncate(good_end)
+                    f.flush()
+                    os.fsync(f.fileno())
+        except FileNotFoundError:
+            pass
+
+    def read_journal(self, journal_file_name):
+        records = []
+        try:
+            with open(journal_file_name, 'r') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError: # A torn final line from a crash mid-append
+                        print('Skipping unreadable Key State journal record in', journal_file_name)
+        except FileNotFoundError:
+            pass
+        return records
+
+    def read_history(self): # All retained state change records, oldest first
+        records = []
+        for generation in range(self.journal_generations, 0, -1):
+            records.extend(self.read_journal(self.journal_file_name + '.' + str(generation)))
+        records.extend(self.read_journal(self.journal_file_name))
+        return records
+
+    def apply_record(self, state, record):
+        if 'Item' in record:
+            if not isinstance(state.get(record['Key']), dict):
+                state[record['Key']] = {}
+            state[record['Key']][record['Item']] = record['Value']
+        else:
+            state[record['Key']] = record['Value']
+        state['Reason'] = record['Reason']
+
+    def changed_records(self, previous_state, state, reason):
+        now = time.time()
+        records = []
+        for key, value in state.items():
+            if key == 'Reason':
+                continue
+            previous_value = previous_state.get(key)
+            if isinstance(value, dict) and isinstance(previous_value, dict): # One record per changed door, blind etc.
+                for item, item_value in value.items():
+                    if item not in previous_value or previous_value[item] != item_value:
+                        records.append({'Time': now, 'Reason': reason, 'Key': key, 'Item': item, 'Value': item_value})
+            elif key not in previous_state or previous_value != value:
+                records.append({'Time': now, 'Reason': reason, 'Key': key, 'Value': value})
+        return records
+
+    def mark_dirty(self, reason):
+        with self.lock:
+            if reason not in self.dirty_reasons:
+                self.dirty_reasons.append(reason)
+            if self.timer is None:
+                self.timer = threading.Timer(self.write_window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+            else:
+                self.merged_count += 1
+
+    def flush(self): # Journals the state changes now, if there are any
+        if self.persisted_state is None: # Nothing has been loaded yet, so there's nothing to compare against
+            self.load()
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.dirty_reasons:
+                return
+            reasons = self.dirty_reasons
+            reason = ', '.join(reasons)
+            self.dirty_reasons = []
+            try:
+                state = json.loads(json.dumps(self.build_state(reason))) # Normalised to what reads back from disk, so unchanged items compare equal
+                records = self.changed_records(self.persisted_state, state, reason)
+                if records:
+                    with open(self.journal_file_name, 'a') as f:
+                        f.write(''.join(json.dumps(record) + '\n' for record in records))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    for record in records:
+                        self.apply_record(self.persisted_state, record)
+                    self.journal_record_count += len(records)
+                    self.write_count += 1
+                if self.journal_record_count >= self.compaction_records:
+                    self.compact()
+            except Exception as e: # The changes stay dirty and are retried after another write window, so that none are lost
+                print('Key State Log write error:', e, '- retrying in', self.write_window, 'seconds')
+                self.dirty_reasons = reasons
+                self.timer = threading.Timer(self.write_window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def compact(self): # Writes the current state as the new snapshot and starts a new journal. Called with the lock held
+        self.write_atomically(json.dumps(self.persisted_state))
+        for generation in range(self.journal_generations - 1, 0, -1):
+            older_file_name = self.journal_file_name + '.' + str(generation)
+            if os.path.exists(older_file_name):
+                os.replace(older_file_name, self.journal_file_name + '.' + str(generation + 1))
+        if os.path.exists(self.journal_file_name):
+            if self.journal_generations > 0:
+                os.replace(self.journal_file_name, self.journal_file_name + '.1')
+            else:
+                os.remove(self.journal_file_name)
+        self.journal_record_count = 0
+
+    def write_atomically(self, contents):
+        temp_file_name = self.file_name + '.tmp'
+        with open(temp_file_name, 'w') as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file_name, self.file_name)
+        directory = os.open(os.path.dirname(os.path.abspath(self.file_name)), os.O_RDONLY) # Make the rename itself durable
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+class MessagePipelineClass(object):
+    # Decouples mqtt ingest from message handling. The paho network thread only enqueues raw messages; one worker thread per lane then
+    # decodes and handles them in arrival order. Per-topic order is kept (each topic is routed to one lane) and a slow handler only
+    # holds up its own lane, so it can't delay door or flood events or starve the broker keepalive. A full lane drops its oldest
+    # message, except for the lossless lanes, whose queues are unbounded so that no state change is ever lost
+    def __init__(self, lanes, queue_bound, lossless_lanes=()):
+        self.queue_bound = queue_bound
+        self.enqueue_lock = threading.Lock()
+        self.lanes = {lane: {'Queue': queue.Queue(maxsize=0 if lane in lossless_lanes else queue_bound), 'Handled': 0, 'Dropped': 0,
+                             'Max Depth': 0, 'Total Latency': 0.0, 'Max Latency': 0.0} for lane in lanes}
+
+    def start(self):
+        for lane in self.lanes:
+            threading.Thread(target=self.run_lane, args=(lane,), name=lane + ' Worker', daemon=True).start()
+
+    def enqueue(self, lane, topic, handler, decoder, payload):
+        lane_state = self.lanes[lane]
+        item = (time.time(), topic, handler, decoder, payload)
+        with self.enqueue_lock:
+            if lane_state['Queue'].full(): # Drop the oldest message on this lane rather than block the caller
+                try:
+                    lane_state['Queue'].get_nowait()
+                    lane_state['Dropped'] += 1
+                except queue.Empty:
+                    pass
+            lane_state['Queue'].put_nowait(item)
+            depth = lane_state['Queue'].qsize()
+            if depth > lane_state['Max Depth']:
+                lane_state['Max Depth'] = depth
+
+    def run_lane(self, lane):
+        lane_state = self.lanes[lane]
+        while True:
+            enqueue_time, topic, handler, decoder, payload = lane_state['Queue'].get()
+            try:
+                handler(topic, decoder(payload))
+            except Exception:
+                print('Error handling', lane, 'message on topic', topic)
+                traceback.print_exc()
+            latency = time.time() - enqueue_time
+            lane_state['Handled'] += 1
+            lane_state['Total Latency'] += latency
+            if latency > lane_state['Max Latency']:
+                lane_state['Max Latency'] = latency
+
+    def get_stats(self): # Current queue depth and handling latency (queueing plus handling time, in seconds) for each lane
+        stats = {}
+        for lane, lane_state in self.lanes.items():
+            handled = lane_state['Handled']
+            stats[lane] = {'Depth': lane_state['Queue'].qsize(), 'Max Depth': lane_state['Max Depth'], 'Handled': handled,
+                           'Dropped': lane_state['Dropped'], 'Max Latency': round(lane_state['Max Latency'], 4),
+                           'Mean Latency': round(lane_state['Total Latency'] / handled, 4) if handled else 0}
+        return stats
+
+class PublishTemplateClass(object):
+    # A json message whose fixed fields are encoded once, when the template is built. Publishing only serialises the values that
+    # are inserted into its slots, which avoids building a dict and running the general-purpose encoder for every message
+    def __init__(self, fixed_fields, value_keys):
+        fixed = ', '.join(json.dumps(key) + ': ' + json.dumps(value) for key, value in fixed_fields)
+        self.segments = []
+        separator = '{' + fixed + ', ' if fixed else '{'
+        for key in value_keys:
+            self.segments.append((separator + json.dumps(key) + ': ').encode('utf-8'))
+            separator = ', '
+        self.suffix = b'}'
+
+    def encode_value(self, value):
+        value_type = type(value)
+        if value_type is bool:
+            return b'true' if value else b'false'
+        if value_type is int:
+            return str(value).encode('utf-8')
+        if value_type is float and value - value == 0: # Finite floats are encoded as json.dumps would. NaN and infinity fall through
+            return repr(value).encode('utf-8')
+        return json.dumps(value).encode('utf-8')
+
+    def render(self, *values):
+        parts = []
+        for segment, value in zip(self.segments, values):
+            parts.append(segment)
+            parts.append(self.encode_value(value))
+        parts.append(self.suffix)
+        return b''.join(parts)
+
+class PacedOutboxClass(object):
+    # Outbound mqtt queue that keeps a minimum spacing between messages to the same accessory without blocking the caller.
+    # Each accessory's messages are sent in the order they were queued, while messages for different accessories are interleaved
+    def __init__(self, spacing):
+        self.spacing = spacing
+        self.condition = threading.Condition()
+        self.pending = {} # Accessory -> deque of (queued time, not-before time, topic, payload)
+        self.next_send_time = {} # Accessory -> earliest time its next message can be sent
+        self.depth = 0
+        self.sent_count = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        threading.Thread(target=self.run, name='Paced Outbox', daemon=True).start()
+
+    def send(self, accessory, topic, payload, delay=0):
+        now = time.time()
+        with self.condition:
+            if accessory not in self.pending:
+                self.pending[accessory] = deque()
+            self.pending[accessory].append((now, now + delay, topic, payload))
+            self.depth += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True: # Wait for the accessory whose next message is due first
+                    now = time.time()
+                    due_accessory = None
+                    due_time = None
+                    for accessory, messages in self.pending.items():
+                        send_time = max(messages[0][1], self.next_send_time.get(accessory, 0))
+                        if due_time is None or send_time < due_time:
+                            due_accessory = accessory
+                            due_time = send_time
+                    if due_accessory is None:
+                        self.condition.wait()
+                    elif due_time > now:
+                        self.condition.wait(due_time - now)
+                    else:
+                        break
+                queued_time, not_before_time, topic, payload = self.pending[due_accessory].popleft()
+                if not self.pending[due_accessory]:
+                    del self.pending[due_accessory]
+                self.next_send_time[due_accessory] = now + self.spacing
+                self.depth -= 1
+            client.publish(topic, payload)
+            latency = time.time() - not_before_time # Time spent waiting for pacing, beyond any requested delay
+            self.sent_count += 1
+            self.total_latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+
+    def get_stats(self):
+        return {'Depth': self.depth, 'Sent': self.sent_count, 'Max Latency': round(self.max_latency, 4),
+                'Mean Latency': round(self.total_latency / self.sent_count, 4) if self.sent_count else 0}
+
+class RollupRingClass(object):
+    # Fixed-size min/mean/max/count rollups of a metric over consecutive buckets of bucket_seconds, for the last capacity buckets.
+    # A value's slot is its bucket number modulo capacity, so a slot still holding an older bucket is simply reset when it's reused
+    def __init__(self, bucket_seconds, capacity):
+        self.bucket_seconds = bucket_seconds
+        self.capacity = capacity
+        self.starts = array('d', [-1.0]) * capacity # Bucket start times. -1 marks an unused slot
+        self.minimums = array('d', [0.0]) * capacity
+        self.maximums = array('d', [0.0]) * capacity
+        self.sums = array('d', [0.0]) * capacity
+        self.counts = array('l', [0]) * capacity
+
+    def add(self, now, value):
+        bucket = int(now // self.bucket_seconds)
+        slot = bucket % self.capacity
+        start = bucket * self.bucket_seconds
+        if self.starts[slot] != start: # Start a new bucket
+            self.starts[slot] = start
+            self.minimums[slot] = value
+            self.maximums[slot] = value
+            self.sums[slot] = value
+            self.counts[slot] = 1
+        else:
+            if value < self.minimums[slot]:
+                self.minimums[slot] = value
+            if value > self.maximums[slot]:
+                self.maximums[slot] = value
+            self.sums[slot] += value
+            self.counts[slot] += 1
+
+    def summary(self, since): # Combines every bucket that overlaps the time since 'since'. Returns None if there are no values
+        minimum = maximum = None
+        total = 0.0
+        count = 0
+        earliest_start = since - self.bucket_seconds
+        for slot in range(self.capacity):
+            if self.starts[slot] > earliest_start:
+                if minimum is None or self.minimums[slot] < minimum:
+                    minimum = self.minimums[slot]
+                if maximum is None or self.maximums[slot] > maximum:
+                    maximum = self.maximums[slot]
+                total += self.sums[slot]
+                count += self.counts[slot]
+        if count == 0:
+            return None
+        return {'Min': minimum, 'Mean': total / count, 'Max': maximum, 'Count': count}
+
+class RingSeriesClass(object):
+    # The recent raw values of one sensor metric in a ring buffer, with 1-minute and 1-hour rollups maintained as each value arrives
+    def __init__(self, raw_capacity, minute_capacity, hour_capacity):
+        self.raw_capacity = raw_capacity
+        self.times = array('d', [0.0]) * raw_capacity
+        self.values = array('d', [0.0]) * raw_capacity
+        self.head = 0 # Slot for the next value
+        self.count = 0
+        self.minutes = RollupRingClass(60, minute_capacity)
+        self.hours = RollupRingClass(3600, hour_capacity)
+
+    def add(self, now, value):
+        self.times[self.head] = now
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.raw_capacity
+        if self.count < self.raw_capacity:
+            self.count += 1
+        self.minutes.add(now, value)
+        self.hours.add(now, value)
+
+    def latest(self): # (time, value) or None
+        if self.count == 0:
+            return None
+        slot = self.head - 1
+        return self.times[slot], self.values[slot]
+
+    def recent(self, since): # Raw (time, value) pairs since 'since', oldest first
+        result = []
+        for offset in range(self.count):
+            slot = (self.head - 1 - offset) % self.raw_capacity
+            if self.times[slot] < since:
+                break
+            result.append((self.times[slot], self.values[slot]))
+        result.reverse()
+        return result
+
+class TimeSeriesStoreClass(object):
+    # In-memory history of every numeric sensor metric, keyed by (sensor name, metric). Each series has a fixed size, so memory doesn't
+    # grow however long the Home Manager runs. Summaries over a period come from the 1-minute rollups for up to the minute rollups'
+    # span and from the 1-hour rollups beyond that, so they include the whole of the oldest overlapping bucket
+    def __init__(self, raw_capacity=360, minute_capacity=180, hour_capacity=168):
+        self.raw_capacity = raw_capacity
+        self.minute_capacity = minute_capacity # 3 hours of minutes
+        self.hour_capacity = hour_capacity # 7 days of hours
+        self.series = {}
+        self.lock = threading.Lock() # Series are added from the pipeline lanes and read from the scheduler and TRMNL push
+
+    def record(self, sensor, metric, value, now=None):
+        if now is None:
+            now = time.time()
+        key = (sensor, metric)
+        series = self.series.get(key)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(key, RingSeriesClass(self.raw_capacity, self.minute_capacity, self.hour_capacity))
+        series.add(now, value)
+
+    def record_readings(self, sensor, readings, now=None): # Records every numeric reading in a readings dict, e.g. an Enviro message
+        if now is None:
+            now = time.time()
+        for metric in readings:
+            value = readings[metric]
+            if isinstance(value, list): # e.g. Hum and Bar, with their Domoticz status
+                value = value[0]
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.record(sensor, metric, value, now)
+
+    def latest(self, sensor, metric): # (time, value) or None
+        series = self.series.get((sensor, metric))
+        return series.latest() if series is not None else None
+
+    def recent(self, sensor, metric, seconds, now=None):
+        series = self.series.get((sensor, metric))
+        if series is None:
+            return []
+        return series.recent((time.time() if now is None else now) - seconds)
+
+    def summary(self, sensor, metric, seconds, now=None): # {'Min', 'Mean', 'Max', 'Count'} over the last 'seconds', or None
+        series = self.series.get((sensor, metric))
+        if series is None:
+            return None
+        since = (time.time() if now is None else now) - seconds
+        if seconds <= 60 * (self.minute_capacity - 1):
+            return series.minutes.summary(since)
+        else:
+            return series.hours.summary(since)
+
+    def get_stats(self):
+        series_bytes = 8 * (2 * self.raw_capacity + 5 * (self.minute_capacity + self.hour_capacity))
+        return {'Series': len(self.series), 'Bytes': len(self.series) * series_bytes}
+
 class HomebridgeClass(object):
     def __init__(self, outdoor_multisensor_names, outdoor_sensors_name, door_sensor_names_locations, enviro_config,
                  window_blind_threshold_1, window_blind_threshold_2, previous_window_blind_state):
@@ -314,6 +922,64 @@ class HomebridgeClass(object):
         # Tilt-based representation: the position axis carries Open (raised) vs lowered, the horizontal tilt axis carries Venetian vs Closed
         self.blind_status_to_position = {'Open': 100, 'Venetian': 0, 'Closed': 0}
         self.blind_status_to_tilt = {'Open': 90, 'Venetian': 90, 'Closed': 0} # 90 deg = slats open (Venetian), 0 deg = slats shut (Closed)
+        # Precompute each Enviro Monitor's accessory names (which are also their service names) so they aren't concatenated on every message
+        self.enviro_accessory_names = {}
+        for enviro_name in self.enviro_config:
+            self.enviro_accessory_names[enviro_name] = {'AQI': enviro_name + self.enviro_aqi_format['name'], 'Reducing': enviro_name + self.enviro_reducing_format['name'],
+                                                        'Ammonia': enviro_name + self.enviro_ammonia_format['name'], 'PM2.5 Alert': enviro_name + self.enviro_PM2_5_alert_format['name'],
+                                                        'Env Temp': enviro_name + self.enviro_temp_format['name'], 'Env Hum': enviro_name + self.enviro_hum_format['name'],
+                                                        'Env Dew': enviro_name + self.enviro_dew_format['name'], 'Env Lux': enviro_name + self.enviro_lux_format['name'],
+                                                        'CO2': enviro_name + self.enviro_CO2_level_format['name']}
+        # Last-value cache for change-only publishing: (name, service_name, characteristic) -> [value, payload, publish time]
+        self.publish_cache = {}
+        self.publish_cache_lock = threading.Lock()
+        self.publish_cache_refresh_interval = 900 # Unchanged values are still re-sent after this many seconds
+        self.suppressed_publish_count = 0
+        self.publish_templates = {} # (name, service_name, characteristic) -> PublishTemplateClass, built on its first publish
+        # Messages that homebridge-mqtt needs spaced out are sent through a paced outbox rather than with sleeps
+        self.outbox = PacedOutboxClass(spacing=0.1)
+
+    def get_publish_template(self, name, service_name, characteristic):
+        key = (name, service_name, characteristic)
+        template = self.publish_templates.get(key)
+        if template is None:
+            if service_name is None: # Some accessories are addressed without a service name
+                template = PublishTemplateClass((('name', name), ('characteristic', characteristic)), ('value',))
+            else:
+                template = PublishTemplateClass((('name', name), ('service_name', service_name), ('characteristic', characteristic)), ('value',))
+            self.publish_templates[key] = template
+        return template
+
+    def publish_if_changed(self, name, service_name, characteristic, value, force=False, delay=0):
+        # Publishes a characteristic unless the same value was sent for it within the refresh interval. A delayed publish goes through the paced outbox
+        key = (name, service_name, characteristic)
+        now = time.time()
+        with self.publish_cache_lock:
+            cached = self.publish_cache.get(key)
+            if (not force and cached is not None and cached[0] == value and type(cached[0]) is type(value) # True == 1, but HomeKit treats them differently
+                and now - cached[2] < self.publish_cache_refresh_interval):
+                self.suppressed_publish_count += 1
+                return
+            payload = self.get_publish_template(name, service_name, characteristic).render(value)
+            self.publish_cache[key] = [value, payload, now]
+        if delay:
+            self.outbox.send(name, self.outgoing_mqtt_topic, payload, delay)
+        else:
+            client.publish(self.outgoing_mqtt_topic, payload)
+
+    def paced_publish(self, name, service_name, characteristic, value, delay=0):
+        # Queues a characteristic on the paced outbox. Messages to the same accessory go out in order, at least outbox.spacing apart
+        self.outbox.send(name, self.outgoing_mqtt_topic, self.get_publish_template(name, service_name, characteristic).render(value), delay)
+
+    def resend_cached_values(self): # Re-sends every cached characteristic, e.g. after reconnecting to the mqtt broker
+        now = time.time()
+        with self.publish_cache_lock:
+            payloads = []
+            for cached in self.publish_cache.values():
+                payloads.append(cached[1])
+                cached[2] = now
+        for payload in payloads:
+            client.publish(self.outgoing_mqtt_topic, payload)
         
     def capture_homebridge_buttons(self, parsed_json):
         if self.dimmer_format['name'] in parsed_json['name']:
@@ -344,19 +1010,10 @@ class HomebridgeClass(object):
                 homebridge_json['characteristic'] = characteristic
                 client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json)) # Close Current and Target Homebridge GarageDoor
  
-    def process_enviro_wind_button(self): #Reset to previous state
-        time.sleep(0.5)
-        homebridge_json = {}
-        homebridge_json['name'] = self.enviro_wind_format['name']
-        homebridge_json['characteristic'] = 'On'
-        homebridge_json['value'] = self.enviro_wind_state['Active']
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-        homebridge_json['characteristic'] = 'RotationSpeed'
-        homebridge_json['value'] = self.enviro_wind_state['Wind Speed']
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))  
-        homebridge_json['characteristic'] = 'RotationDirection'
-        homebridge_json['value'] = self.enviro_wind_state['Direction']
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
+    def process_enviro_wind_button(self): #Reset to previous state, half a second after the button press
+        self.paced_publish(self.enviro_wind_format['name'], None, 'On', self.enviro_wind_state['Active'], delay=0.5)
+        self.paced_publish(self.enviro_wind_format['name'], None, 'RotationSpeed', self.enviro_wind_state['Wind Speed'])
+        self.paced_publish(self.enviro_wind_format['name'], None, 'RotationDirection', self.enviro_wind_state['Direction'])
 
     def process_blind_button(self, parsed_json):
         #print('Homebridge: Process Blind Button', parsed_json)
@@ -365,7 +1022,7 @@ class HomebridgeClass(object):
         if parsed_json['service_name'] == self.auto_blind_override_button_format['service_name']:
             auto_override = parsed_json['value']
             window_blind[blind_name].change_auto_override(auto_override)
-            mgr.auto_blind_override_changed = {'Changed': True, 'Blind': blind_name, 'State': auto_override}
+            mgr.post_blind_trigger(blind_name, 'Auto Override', auto_override)
         # Set blind high temp threshold
         elif parsed_json['service_name'] == self.blinds_temp_format['high_temp_service_name'] and parsed_json['characteristic'] == 'TargetTemperature':
             window_blind[blind_name].set_high_temp(parsed_json['value'])
@@ -374,8 +1031,7 @@ class HomebridgeClass(object):
             window_blind[blind_name].set_low_temp(parsed_json['value'])
         # Force the temp thermostats back to 'Cool' (low) and 'Heat' (high) if an attempt is made to change their state
         elif (parsed_json['service_name'] == self.blinds_temp_format['high_temp_service_name'] or parsed_json['service_name'] == self.blinds_temp_format['low_temp_service_name']) and parsed_json['characteristic'] == 'TargetHeatingCoolingState':
-            time.sleep(0.1)
-            self.update_blind_temp_states(blind_name)
+            self.update_blind_temp_states(blind_name, force=True, delay=0.1) # HomeKit has changed the state, so it must be re-sent even though it's cached
         # Whole-group blind control: position axis = Open vs lowered, horizontal tilt axis = Venetian vs Closed.
         # HomeKit sends these as separate messages, so each is combined with the last-known other axis.
         elif parsed_json['characteristic'] == 'TargetPosition':
@@ -389,20 +1045,15 @@ class HomebridgeClass(object):
         # Reflect the whole-group blind state back to the HomeKit WindowCovering: the position axis (Open vs
         # lowered) and the horizontal tilt axis (Venetian vs Closed). Send each Current before its Target (so
         # HomeKit derives no motion) and PositionState 'Stopped' last, spaced so homebridge-mqtt doesn't
-        # coalesce/drop the reconciling updates and leave the tile stuck showing 'Opening'/'Closing'.
-        homebridge_json = {}
-        homebridge_json['name'] = blind_room
-        homebridge_json['service_name'] = blind_room
+        # coalesce/drop the reconciling updates and leave the tile stuck showing 'Opening'/'Closing'. The spacing is kept by
+        # the paced outbox, so the caller isn't blocked.
         status = window_blind_config['status']
         position = self.blind_status_to_position[status]
         tilt = self.blind_status_to_tilt[status]
         for characteristic, value in (('CurrentPosition', position), ('TargetPosition', position),
                                       ('CurrentHorizontalTiltAngle', tilt), ('TargetHorizontalTiltAngle', tilt),
                                       ('PositionState', 2)):
-            homebridge_json['characteristic'] = characteristic
-            homebridge_json['value'] = value
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-            time.sleep(0.1)
+            self.paced_publish(blind_room, blind_room, characteristic, value)
 
     def set_auto_blind_override_button(self, blind_room, state):
         homebridge_json = {}
@@ -413,39 +1064,19 @@ class HomebridgeClass(object):
         client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
 
     def update_blind_current_temps(self, blind_room, temp):
-        homebridge_json = {}
-        homebridge_json['name'] = blind_room
-        homebridge_json['characteristic'] = 'CurrentTemperature'
-        homebridge_json['value'] = temp
-        homebridge_json['service_name'] = self.blinds_temp_format['high_temp_service_name']
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-        homebridge_json['service_name'] = self.blinds_temp_format['low_temp_service_name']
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
+        self.publish_if_changed(blind_room, self.blinds_temp_format['high_temp_service_name'], 'CurrentTemperature', temp)
+        self.publish_if_changed(blind_room, self.blinds_temp_format['low_temp_service_name'], 'CurrentTemperature', temp)
         self.update_blind_temp_states(blind_room)
 
     def update_blind_target_temps(self, blind_room, high_temp, low_temp):
-        homebridge_json = {}
-        homebridge_json['name'] = blind_room
-        homebridge_json['characteristic'] = 'TargetTemperature'
-        homebridge_json['value'] = high_temp
-        homebridge_json['service_name'] = self.blinds_temp_format['high_temp_service_name']
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-        homebridge_json['value'] = low_temp
-        homebridge_json['service_name'] = self.blinds_temp_format['low_temp_service_name']
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
+        self.publish_if_changed(blind_room, self.blinds_temp_format['high_temp_service_name'], 'TargetTemperature', high_temp)
+        self.publish_if_changed(blind_room, self.blinds_temp_format['low_temp_service_name'], 'TargetTemperature', low_temp)
         self.update_blind_temp_states(blind_room)
 
-    def update_blind_temp_states(self, blind_room):
+    def update_blind_temp_states(self, blind_room, force=False, delay=0):
         # Sets the Low Temp thermostat to 'Cool' and the High Temp thermostat to 'Heat'
-        homebridge_json = {}
-        homebridge_json['name'] = blind_room
-        homebridge_json['characteristic'] = 'TargetHeatingCoolingState'
-        homebridge_json['service_name'] = self.blinds_temp_format['low_temp_service_name']
-        homebridge_json['value'] = 2
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-        homebridge_json['service_name'] = self.blinds_temp_format['high_temp_service_name']
-        homebridge_json['value'] = 1
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
+        self.publish_if_changed(blind_room, self.blinds_temp_format['low_temp_service_name'], 'TargetHeatingCoolingState', 2, force, delay)
+        self.publish_if_changed(blind_room, self.blinds_temp_format['high_temp_service_name'], 'TargetHeatingCoolingState', 1, force, delay)
 
     def update_temperature(self, name, temperature):
         homebridge_json = {}
@@ -576,92 +1207,35 @@ class HomebridgeClass(object):
             print("Invalid Garage Door Status Message", state)
         
     def update_enviro_aqi(self, name, enviro_config, aqi, parsed_json, individual_aqi, PM2_5_alert_level, gas_readings, max_CO2, CO2_threshold):
-        homebridge_json = {}
-        homebridge_json['name'] = name + self.enviro_aqi_format['name']
-        homebridge_json['service_name'] = name + self.enviro_aqi_format['service_name']
-        homebridge_json['characteristic'] = 'AirQuality'
-        homebridge_json['value'] = aqi
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-        homebridge_json['characteristic'] = 'PM2_5Density' # Requires homebridge-mqtt >= 0.6.2
-        homebridge_json['value'] = round(parsed_json['P2.5'], 0)
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-        homebridge_json['characteristic'] = 'PM10Density'
-        homebridge_json['value'] = round(parsed_json['P10'], 0)
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
+        accessory = self.enviro_accessory_names[name] # Each Enviro accessory's name is also its service name
+        self.publish_if_changed(accessory['AQI'], accessory['AQI'], 'AirQuality', aqi)
+        self.publish_if_changed(accessory['AQI'], accessory['AQI'], 'PM2_5Density', round(parsed_json['P2.5'], 0)) # Requires homebridge-mqtt >= 0.6.2
+        self.publish_if_changed(accessory['AQI'], accessory['AQI'], 'PM10Density', round(parsed_json['P10'], 0))
         if 'VOC' in enviro_config['Device IDs'] and 'VOC' in parsed_json:
-            homebridge_json['characteristic'] = 'VOCDensity'
             if parsed_json['VOC'] > 1000: # HomeKit Max limit
-                homebridge_json['value'] = 1000
+                self.publish_if_changed(accessory['AQI'], accessory['AQI'], 'VOCDensity', 1000)
             else:
-                homebridge_json['value'] = round(parsed_json['VOC'], 0)
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
+                self.publish_if_changed(accessory['AQI'], accessory['AQI'], 'VOCDensity', round(parsed_json['VOC'], 0))
         if gas_readings:
-            homebridge_json['characteristic'] = 'NitrogenDioxideDensity'
-            homebridge_json['value'] = parsed_json['Oxi']
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-            homebridge_json['name'] = name + self.enviro_reducing_format['name']
-            homebridge_json['service_name'] = name + self.enviro_reducing_format['service_name']
-            homebridge_json['characteristic'] = 'AirQuality'
-            homebridge_json['value'] = individual_aqi['Red']
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-            homebridge_json['characteristic'] = 'NitrogenDioxideDensity'
-            homebridge_json['value'] = parsed_json['Red']
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-            homebridge_json['name'] = name + self.enviro_ammonia_format['name']
-            homebridge_json['service_name'] = name + self.enviro_ammonia_format['service_name']
-            homebridge_json['characteristic'] = 'AirQuality'
-            homebridge_json['value'] = individual_aqi['NH3']
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-            homebridge_json['characteristic'] = 'NitrogenDioxideDensity'
-            homebridge_json['value'] = parsed_json['NH3']
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
+            self.publish_if_changed(accessory['AQI'], accessory['AQI'], 'NitrogenDioxideDensity', parsed_json['Oxi'])
+            self.publish_if_changed(accessory['Reducing'], accessory['Reducing'], 'AirQuality', individual_aqi['Red'])
+            self.publish_if_changed(accessory['Reducing'], accessory['Reducing'], 'NitrogenDioxideDensity', parsed_json['Red'])
+            self.publish_if_changed(accessory['Ammonia'], accessory['Ammonia'], 'AirQuality', individual_aqi['NH3'])
+            self.publish_if_changed(accessory['Ammonia'], accessory['Ammonia'], 'NitrogenDioxideDensity', parsed_json['NH3'])
         if 'CO2' in enviro_config['Device IDs'] and 'CO2' in parsed_json:
-            homebridge_json['name'] = name + self.enviro_CO2_level_format['name']
-            homebridge_json['service_name'] = name + self.enviro_CO2_level_format['service_name']
-            homebridge_json['characteristic'] = 'CarbonDioxideLevel'
-            homebridge_json['value'] = round(parsed_json['CO2'], 0)
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-            homebridge_json['characteristic'] = 'CarbonDioxideDetected'
-            if homebridge_json['value'] < CO2_threshold:
-                homebridge_json['value'] = 0
-            else:
-                homebridge_json['value'] = 1
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-            homebridge_json['characteristic'] = 'CarbonDioxidePeakLevel'
-            homebridge_json['value'] = max_CO2
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-        homebridge_json['name'] = name + self.enviro_PM2_5_alert_format['name']
-        homebridge_json['service_name'] = name + self.enviro_PM2_5_alert_format['service_name']
-        homebridge_json['characteristic'] = 'MotionDetected'
-        if parsed_json['P2.5'] >= PM2_5_alert_level:
-            homebridge_json['value'] = True
-        else:
-            homebridge_json['value'] = False
-        client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
+            CO2_level = round(parsed_json['CO2'], 0)
+            self.publish_if_changed(accessory['CO2'], accessory['CO2'], 'CarbonDioxideLevel', CO2_level)
+            self.publish_if_changed(accessory['CO2'], accessory['CO2'], 'CarbonDioxideDetected', 0 if CO2_level < CO2_threshold else 1)
+            self.publish_if_changed(accessory['CO2'], accessory['CO2'], 'CarbonDioxidePeakLevel', max_CO2)
+        self.publish_if_changed(accessory['PM2.5 Alert'], accessory['PM2.5 Alert'], 'MotionDetected', parsed_json['P2.5'] >= PM2_5_alert_level)
         if enviro_config['Capture Non AQI']: # If there are Non AQI Readings
-            homebridge_json['name'] = name + self.enviro_temp_format['name']
-            homebridge_json['service_name'] = name + self.enviro_temp_format['service_name']
-            homebridge_json['characteristic'] = 'CurrentTemperature'
-            homebridge_json['value'] = parsed_json['Temp']
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-            homebridge_json['name'] = name + self.enviro_hum_format['name']
-            homebridge_json['service_name'] = name + self.enviro_hum_format['service_name']
-            homebridge_json['characteristic'] = 'CurrentRelativeHumidity'
-            homebridge_json['value'] = parsed_json['Hum'][0]
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-            homebridge_json['name'] = name + self.enviro_dew_format['name']
-            homebridge_json['service_name'] = name + self.enviro_dew_format['service_name']
-            homebridge_json['characteristic'] = 'CurrentTemperature'
-            homebridge_json['value'] = parsed_json['Dew']
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
-            homebridge_json['name'] = name + self.enviro_lux_format['name']
-            homebridge_json['service_name'] = name + self.enviro_lux_format['service_name']
-            homebridge_json['characteristic'] = 'CurrentAmbientLightLevel'
+            self.publish_if_changed(accessory['Env Temp'], accessory['Env Temp'], 'CurrentTemperature', parsed_json['Temp'])
+            self.publish_if_changed(accessory['Env Hum'], accessory['Env Hum'], 'CurrentRelativeHumidity', parsed_json['Hum'][0])
+            self.publish_if_changed(accessory['Env Dew'], accessory['Env Dew'], 'CurrentTemperature', parsed_json['Dew'])
             light_level = parsed_json['Lux']
             if light_level < 0.0001:
                 light_level = 0.0001 #HomeKit minValue is set to 0.0001 Lux
-            homebridge_json['value'] = light_level
-            client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
+            self.publish_if_changed(accessory['Env Lux'], accessory['Env Lux'], 'CurrentAmbientLightLevel', light_level)
             
     def reset_enviro_wind(self):
         homebridge_json = {}
@@ -686,7 +1260,7 @@ class HomebridgeClass(object):
         self.enviro_wind_state['Wind Speed'] = round(wind_data['Gust km/h'])
         if self.enviro_wind_state['Wind Speed'] > 100:
             self.enviro_wind_state['Wind Speed'] = 100 #Limit wind speed to 100km/h
-        if wind_data['Direction'] == 'S' or wind_data['Direction'] == 'E':
+        if 45 <= int(wind_data['Bearing']) < 225: # Easterly and southerly winds
             self.enviro_wind_state['Direction'] = 1 #Anticlockwise
         else:
             self.enviro_wind_state['Direction'] = 0 #Clockwise
@@ -702,7 +1276,7 @@ class HomebridgeClass(object):
         client.publish(self.outgoing_mqtt_topic, json.dumps(homebridge_json))
         
 class DomoticzClass(object): # Manages communications to and from the z-wave objects
-    def __init__(self):
+    def __init__(self, send_policies):
         self.outgoing_mqtt_topic = 'domoticz/in'
         # Set up Domoticz label formats so that incoming message names can be decoded
         self.temperature_humidity_label = ' Climate'
@@ -710,81 +1284,112 @@ class DomoticzClass(object): # Manages communications to and from the z-wave obj
         self.motion_label = ' Motion'
         self.door_label = ' Door'
         self.flood_label = ' Flooding'
-        self.shelly_power_idx = 1121
-        
-    def process_device_data(self, parsed_json):
-        # Selects the object and method for incoming multisensor, door sensor, flood sensor and light dimmer messages
-        sensor_name = parsed_json['name'] # This is where Domoticz sends the sensor's name
-        # Determine which sensor label is in the name, remove the sensor label (leaving the sensor object name)
-        # and call the relevant sensor method for that object
-        if self.temperature_humidity_label in sensor_name: # If it's a temp/humidity sensor
-            multisensor[sensor_name[0:sensor_name.find(self.temperature_humidity_label)]].process_temperature_humidity(parsed_json)
-        elif self.light_level_label in sensor_name: # If it's a light level sensor
-            multisensor[sensor_name[0:sensor_name.find(self.light_level_label)]].process_light_level(parsed_json)
-        elif self.motion_label in sensor_name: # If it's a motion sensor
-            multisensor[sensor_name[0:sensor_name.find(self.motion_label)]].process_motion(parsed_json)
-        elif self.door_label in sensor_name: # If it's a door sensor
-            #print('Door Message', sensor_name, parsed_json)
-            door_sensor[sensor_name[0:sensor_name.find(self.door_label)]].process_door_state_change(parsed_json)
-        elif self.flood_label in sensor_name: # If it's a flood sensor
-            #print('Flood Message', sensor_name, parsed_json)
-            flood_sensor[sensor_name[0:sensor_name.find(self.flood_label)]].process_flood_state_change(parsed_json)
+        self.publish_templates = {} # idx -> PublishTemplateClass, built on its first publish
+        # Enviro readings are only re-sent to Domoticz when they move outside their deadband (see mgr.domoticz_send_policies)
+        self.send_policies = send_policies
+        self.last_sent = {} # idx -> {'Time': publish time, 'Values': the readings that were sent}
+        self.suppressed_counts = {} # idx -> number of suppressed messages
+        self.device_handlers = {} # Domoticz device name -> (bound sensor method, worker lane), built by build_device_index()
+        self.ignored_device_messages = 0
 
+    def build_device_index(self):
+        # Maps each modelled Domoticz device name (sensor object name + sensor label) to the sensor method that processes it and its
+        # worker lane, so that domoticz/out messages for the rest of the Z-Wave network are dropped with a single lookup. Door and flood
+        # state changes have their own lossless lane, so that a burst of multisensor readings can neither delay nor displace them
+        device_handlers = {}
+        if mgr.multisensors_present:
+            for name in multisensor:
+                device_handlers[name + self.temperature_humidity_label] = (multisensor[name].process_temperature_humidity, 'Domoticz')
+                device_handlers[name + self.light_level_label] = (multisensor[name].process_light_level, 'Domoticz')
+                device_handlers[name + self.motion_label] = (multisensor[name].process_motion, 'Domoticz')
+        if mgr.door_sensors_present:
+            for name in door_sensor:
+                device_handlers[name + self.door_label] = (door_sensor[name].process_door_state_change, 'Domoticz Events')
+        if mgr.flood_sensors_present:
+            for name in flood_sensor:
+                device_handlers[name + self.flood_label] = (flood_sensor[name].process_flood_state_change, 'Domoticz Events')
+        self.device_handlers = device_handlers
+
+    def dispatch_device_message(self, topic, parsed_json):
+        # Runs on the Domoticz Sorter lane. Queues incoming multisensor, door sensor and flood sensor messages for their device's lane.
+        # Devices that aren't modelled are ignored here, so they never occupy a device lane
+        device_handler = self.device_handlers.get(parsed_json.get('name')) # This is where Domoticz sends the sensor's name
+        if device_handler is None:
+            self.ignored_device_messages += 1
+            return
+        handler, lane = device_handler
+        pipeline.enqueue(lane, topic, lambda topic, parsed_json: handler(parsed_json), mgr.decode_decoded_payload, parsed_json)
+
+    def publish(self, idx, nvalue, svalue):
+        template = self.publish_templates.get(idx)
+        if template is None:
+            template = PublishTemplateClass((('idx', idx),), ('nvalue', 'svalue'))
+            self.publish_templates[idx] = template
+        client.publish(self.outgoing_mqtt_topic, template.render(nvalue, svalue))
+
+    def publish_if_material(self, idx, readings, nvalue, svalue):
+        # Publishes to an Enviro idx only if one of its readings has moved outside its deadband and the idx's minimum interval has passed,
+        # or if its heartbeat interval has passed. readings is a list of (measurement type, value) pairs. Other messages are counted and dropped
+        policy = self.send_policies.get(readings[0][0], self.send_policies['Default'])
+        now = time.time()
+        last_sent = self.last_sent.get(idx)
+        if last_sent is not None:
+            elapsed = now - last_sent['Time']
+            if elapsed < policy['Heartbeat']:
+                changed = False
+                if elapsed >= policy['Min Interval']:
+                    for (measurement, value), previous_value in zip(readings, last_sent['Values']):
+                        if isinstance(value, (int, float)) and isinstance(previous_value, (int, float)):
+                            measurement_policy = self.send_policies.get(measurement, self.send_policies['Default'])
+                            if abs(value - previous_value) > max(measurement_policy['Absolute'], measurement_policy['Relative'] * abs(previous_value)):
+                                changed = True
+                                break
+                        elif value != previous_value:
+                            changed = True
+                            break
+                if not changed:
+                    self.suppressed_counts[idx] = self.suppressed_counts.get(idx, 0) + 1
+                    return
+        self.last_sent[idx] = {'Time': now, 'Values': [value for measurement, value in readings]}
+        self.publish(idx, nvalue, svalue)
 
     def update_enviro_aqi(self, name, enviro_config, aqi, parsed_json):
         #print('Incoming Domoticz Enviro', parsed_json, enviro_config)
-        domoticz_json = {}
-        domoticz_json['nvalue'] = 0
         non_aqi_message = {}
         for measurement in enviro_config['Device IDs']:
             if (measurement == 'Temp' or measurement == 'Hum' or measurement == 'Bar') and measurement in parsed_json:
                 non_aqi_message[measurement] = parsed_json[measurement]
             elif (measurement == 'VOC' or measurement == 'CO2') and measurement in parsed_json:
-                domoticz_json['idx'] = enviro_config['Device IDs'][measurement]
-                domoticz_json['nvalue'] = parsed_json[measurement]
-                domoticz_json['svalue'] = ""
-                #print('Domoticz', domoticz_json)
-                client.publish(self.outgoing_mqtt_topic, json.dumps(domoticz_json))
-            elif measurement != 'AQI' and measurement in parsed_json:
-                domoticz_json['idx'] = enviro_config['Device IDs'][measurement]
-                domoticz_json['nvalue'] = 0
-                domoticz_json['svalue'] = str(parsed_json[measurement])
-                #print('Domoticz', domoticz_json)
-                client.publish(self.outgoing_mqtt_topic, json.dumps(domoticz_json))
-        domoticz_json['idx'] = enviro_config['Device IDs']['AQI']
-        domoticz_json['nvalue'] = 0
-        domoticz_json['svalue'] = str(aqi)
-        #print('Domoticz', domoticz_json)
-        client.publish(self.outgoing_mqtt_topic, json.dumps(domoticz_json))
+                self.publish_if_material(enviro_config['Device IDs'][measurement], [(measurement, parsed_json[measurement])], parsed_json[measurement], "")
+            elif measurement != 'AQI' and measurement != 'Wind' and measurement in parsed_json: # Wind has its own message below
+                self.publish_if_material(enviro_config['Device IDs'][measurement], [(measurement, parsed_json[measurement])], 0, str(parsed_json[measurement]))
+        self.publish_if_material(enviro_config['Device IDs']['AQI'], [('AQI', aqi)], 0, str(aqi))
         if non_aqi_message: # If there are some climate messages
-            domoticz_json['idx'] = enviro_config['Device IDs']['Temp']
-            domoticz_json['nvalue'] = 0
-            domoticz_json['svalue'] = str(non_aqi_message['Temp']) + ';'+ str(non_aqi_message['Hum'][0]) + ';' + non_aqi_message['Hum'][1] + ';' + str(non_aqi_message['Bar'][0]) + ';' + non_aqi_message['Bar'][1]
-            #print('Domoticz', domoticz_json)
-            client.publish(self.outgoing_mqtt_topic, json.dumps(domoticz_json))                       
+            self.publish_if_material(enviro_config['Device IDs']['Temp'],
+                                     [('Temp', non_aqi_message['Temp']), ('Hum', non_aqi_message['Hum'][0]), ('Hum', non_aqi_message['Hum'][1]),
+                                      ('Bar', non_aqi_message['Bar'][0]), ('Bar', non_aqi_message['Bar'][1])],
+                                     0, str(non_aqi_message['Temp']) + ';'+ str(non_aqi_message['Hum'][0]) + ';' + non_aqi_message['Hum'][1] + ';' +
+                                     str(non_aqi_message['Bar'][0]) + ';' + non_aqi_message['Bar'][1])
             if 'Wind' in parsed_json:
                 if parsed_json['Wind'] != {}:
                     wind_data = parsed_json['Wind']
                     wind_speed = wind_data['m/s'] * 10 #Domoticz requires wind speed in m/sec * 10
                     wind_gust = wind_data['Gust m/s'] * 10 #Domoticz requires wind speed in m/sec * 10
                     wind_chill = wind_data['Chill']
-                    domoticz_json = {}
-                    domoticz_json['idx'] = enviro_config['Device IDs']['Wind']
-                    domoticz_json['nvalue'] = 0
-                    domoticz_json['svalue'] = wind_data['Bearing'] + ';' + wind_data['Direction'] + ';' + str(wind_speed) + ';' + str(wind_gust) + ';' + str(non_aqi_message['Temp']) + ';' + str(wind_chill)
-                    #print('Wind Domoticz', domoticz_json)
-                    client.publish(self.outgoing_mqtt_topic, json.dumps(domoticz_json))
-
-    def update_electricity_data(self, total_power, total_energy):
-        #print ('Update Domoticz Electricity', total_power, total_energy)
+                    self.publish_if_material(enviro_config['Device IDs']['Wind'],
+                                             [('Wind', wind_data['m/s']), ('Wind', wind_data['Gust m/s']), ('Wind', wind_data['Direction']),
+                                              ('Temp', non_aqi_message['Temp']), ('Temp', wind_chill)],
+                                             0, wind_data['Bearing'] + ';' + wind_data['Direction'] + ';' + str(wind_speed) + ';' +
+                                             str(wind_gust) + ';' + str(non_aqi_message['Temp']) + ';' + str(wind_chill))
+
+    def update_electricity_data(self, idx, total_power, total_energy):
+        #print ('Update Domoticz Electricity', idx, total_power, total_energy)
         send_power = round(total_power,1)
         send_energy = int(total_energy)
-        domoticz_json = {}
-        domoticz_json['idx'] = self.shelly_power_idx
-        domoticz_json['nvalue'] = 0
-        domoticz_json['svalue'] = str(send_power) + ';' + str(send_energy)
-        #print('Electricity Domoticz', domoticz_json)
-        client.publish(self.outgoing_mqtt_topic, json.dumps(domoticz_json))    
+        self.publish(idx, 0, str(send_power) + ';' + str(send_energy))
+
+    def update_energy_cost(self, idx, cost): # A Domoticz Custom Sensor with $ as its axis label
+        self.publish(idx, 0, str(round(cost, 2)))
                         
 class FloodSensorClass(object): 
     def __init__(self, name):        
@@ -850,7 +1455,7 @@ class DoorSensorClass(object):
                 door_state = 'Open' if self.current_door_opened else 'Closed'
                 window_blind[blind_name].window_blind_config['blind_doors'][self.door]['door_state'] = door_state
                 window_blind[blind_name].window_blind_config['blind_doors'][self.door]['door_state_changed'] = True
-                mgr.blind_control_door_changed = {'State': self.current_door_opened, 'Blind': blind_name, 'Changed': True}
+                mgr.post_blind_trigger(blind_name, 'Door Changed', self.current_door_opened)
             self.previous_door_opened = self.current_door_opened
             mgr.log_key_states("Door State Change")
 
@@ -867,6 +1472,8 @@ class MultisensorClass(object):
 
     def process_temperature_humidity(self, parsed_json):
         temperature = float(parsed_json['svalue1'])
+        mgr.sensor_history.record(self.name, 'Temperature', temperature)
+        mgr.sensor_history.record(self.name, 'Humidity', int(parsed_json['svalue2']))
         if temperature != self.sensor_types_with_value['Temperature']:
             self.sensor_types_with_value['Temperature'] = temperature
             homebridge.update_temperature(self.name, temperature)
@@ -877,11 +1484,12 @@ class MultisensorClass(object):
 
     def process_light_level(self, parsed_json):
         light_level = int(parsed_json['svalue1'])
+        mgr.sensor_history.record(self.name, 'Light Level', light_level)
         if abs(light_level - self.sensor_types_with_value['Light Level']) >= 2:
             self.sensor_types_with_value['Light Level'] = light_level
             homebridge.update_light_level(self.name, light_level)
             if mgr.window_blinds_present and self.blind_sensor['Blind Control']: # Trigger the blind sunlight algorithm in the main loop
-                mgr.call_room_sunlight_control = {'State': True, 'Blind': self.blind_sensor['Blind Name'], 'Light Level': light_level}
+                mgr.post_blind_trigger(self.blind_sensor['Blind Name'], 'Light Level', light_level)
 
     def process_motion(self, parsed_json):
         motion_value = parsed_json['nvalue']
@@ -889,6 +1497,7 @@ class MultisensorClass(object):
             motion_detected = True
         else:
             motion_detected = False
+        mgr.sensor_history.record(self.name, 'Motion', int(motion_detected))
         if motion_detected != self.sensor_types_with_value['Motion']:
             self.sensor_types_with_value['Motion'] = motion_detected
             homebridge.update_motion(self.name, motion_detected)
@@ -928,6 +1537,306 @@ class AquariumClass:
         elif parsed_json['service'] == 'Restart':
             mgr.print_update('Aquarium Heartbeat Lost. Restarting Monitor')
             
+class PeakTrackerClass(object):
+    # The peak of the values in the last window_seconds, from a deque of (time, value) with decreasing values: O(1) amortised per value.
+    # summary() is a compact form for persistence, with the candidates reduced to the latest and highest in each bucket_seconds
+    def __init__(self, window_seconds, bucket_seconds):
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.candidates = deque() # (time, value)
+        self.lock = threading.Lock() # Values arrive on the Enviro lane. Summaries are read for the key state log
+
+    def add(self, value, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            while self.candidates and self.candidates[-1][1] <= value: # Can never be the peak again
+                self.candidates.pop()
+            self.candidates.append((now, value))
+            self.expire(now)
+
+    def expire(self, now): # Called with the lock held
+        cutoff = now - self.window_seconds
+        while self.candidates and self.candidates[0][0] <= cutoff:
+            self.candidates.popleft()
+
+    def peak(self, now=None):
+        with self.lock:
+            self.expire(time.time() if now is None else now)
+            return self.candidates[0][1] if self.candidates else 0
+
+    def summary(self): # [[time, value], ...], at most one entry per bucket
+        compact = []
+        with self.lock:
+            for sample_time, value in self.candidates: # Later candidates in a bucket are lower, so keep the first's value with the last's time
+                if compact and int(compact[-1][0] // self.bucket_seconds) == int(sample_time // self.bucket_seconds):
+                    compact[-1][0] = round(sample_time)
+                else:
+                    compact.append([round(sample_time), value])
+        return compact
+
+    def restore(self, summary):
+        with self.lock:
+            self.candidates = deque((sample_time, value) for sample_time, value in summary)
+            self.expire(time.time())
+
+class AqiEngineClass(object):
+    # Classifies air quality readings into AQI levels against array-backed band tables. A reading's AQI level is one more than the highest
+    # band boundary that it has met or exceeded. The bands aren't necessarily ascending (e.g. NH3), so each boundary is compiled to the
+    # minimum of itself and all higher boundaries. That gives an ascending table with the same result, so a reading's level is one bisect.
+    # Live messages are scored as a batch of one, through the same code as re-scoring stored history
+    def __init__(self, air_reading_bands, levels=4):
+        self.levels = levels # Number of band boundaries checked. The last band entry is the top of the scale and isn't a boundary
+        self.retune(air_reading_bands)
+
+    def retune(self, air_reading_bands): # Recompiles the band tables, e.g. before re-scoring history against new bands
+        self.air_reading_bands = air_reading_bands
+        self.band_tables = {}
+        for reading in air_reading_bands:
+            boundaries = air_reading_bands[reading][:self.levels]
+            table = array('d', boundaries)
+            for boundary in range(len(table) - 2, -1, -1):
+                if table[boundary + 1] < table[boundary]:
+                    table[boundary] = table[boundary + 1]
+            self.band_tables[reading] = table
+
+    def classify_series(self, reading, values): # AQI levels for a series of values of one reading
+        table = self.band_tables[reading]
+        return array('b', [bisect_right(table, value) if value == value else 0 for value in values]) # value != value is a NaN, which meets no boundary
+
+    def score_batch(self, records, valid_aqi_readings):
+        # Scores a batch of readings dicts (e.g. stored Enviro messages). Returns a list of (max AQI, individual AQI dict) tuples, one per record
+        individual_aqis = []
+        columns = {} # Each reading's values across the batch, so that each reading is classified in one pass
+        for record in records:
+            individual_aqi = {}
+            for reading in record:
+                if reading in valid_aqi_readings:
+                    individual_aqi[reading] = 0 # Placeholder, to keep the message's reading order
+                    if reading not in columns:
+                        columns[reading] = ([], [])
+                    columns[reading][0].append(individual_aqi)
+                    columns[reading][1].append(record[reading])
+            individual_aqis.append(individual_aqi)
+        for reading in columns:
+            for individual_aqi, aqi in zip(columns[reading][0], self.classify_series(reading, columns[reading][1])):
+                individual_aqi[reading] = aqi
+        return [(max(individual_aqi.values(), default=0), individual_aqi) for individual_aqi in individual_aqis]
+
+    def score(self, parsed_json, valid_aqi_readings): # A live message is a batch of one
+        return self.score_batch([parsed_json], valid_aqi_readings)[0]
+
+class SlidingWindowClass(object):
+    # Mean and maximum of the values added in the last window_seconds, each in O(1) amortised time per value: a running sum for the mean and
+    # a deque of decreasing values for the maximum. Values added less than sample_interval seconds after the previous one are skipped
+    def __init__(self, window_seconds, sample_interval=0):
+        self.window_seconds = window_seconds
+        self.sample_interval = sample_interval
+        self.samples = deque() # (time, value)
+        self.max_candidates = deque() # (time, value), with decreasing values. The head is the window's maximum
+        self.total = 0.0
+
+    def add(self, value, now=None): # Returns False if the value was skipped
+        if now is None:
+            now = time.time()
+        if self.samples and now - self.samples[-1][0] < self.sample_interval:
+            self.expire(now)
+            return False
+        self.samples.append((now, value))
+        self.total += value
+        while self.max_candidates and self.max_candidates[-1][1] <= value: # Can never be the maximum again
+            self.max_candidates.pop()
+        self.max_candidates.append((now, value))
+        self.expire(now)
+        return True
+
+    def expire(self, now):
+        cutoff = now - self.window_seconds
+        while len(self.samples) > 1 and self.samples[0][0] <= cutoff: # Always keep the latest value
+            self.total -= self.samples.popleft()[1]
+        while self.max_candidates[0][0] < self.samples[0][0]:
+            self.max_candidates.popleft()
+
+    def count(self):
+        return len(self.samples)
+
+    def mean(self):
+        if len(self.samples) == 1:
+            self.total = self.samples[0][1] # Clears accumulated rounding error in the running sum
+        return self.total / len(self.samples)
+
+    def max(self):
+        return self.max_candidates[0][1]
+
+class WindEngineClass(object):
+    # Estimates a 2-D wind vector from the air pressures at any number of Enviro Monitors. Each update solves, by least squares over
+    # every pair of monitors with fresh readings, for the horizontal pressure gradient g (hPa/m) that best explains their pressure
+    # differences: the normal equations M g = b, with M = sum(d d^T) and b = sum(d dp) over the pairs' position differences d and pressure
+    # differences dp. When the monitors are all in a line, M has rank one and its pseudo-inverse M / trace(M)^2 gives the gradient
+    # along that line. The wind's bearing is towards the higher pressure (i.e. the direction the wind comes from) and its speed is
+    # proportional to the gradient's magnitude
+    compass_points = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+
+    def __init__(self, wind_config):
+        self.sources = wind_config['Sources']
+        self.max_age = wind_config['Max Age Seconds']
+        self.readings = {} # Source name -> (time, offset-corrected air pressure)
+        self.results = SlidingWindowClass(wind_config['Window Seconds'], wind_config['Sample Interval']) # Historical gradient magnitudes
+
+    def update(self, name, air_pressure, now=None): # Returns the wind data, or None if there aren't two fresh readings
+        if now is None:
+            now = time.time()
+        self.readings[name] = (now, air_pressure + self.sources[name]['Offset'])
+        gradient = self.solve(now)
+        if gradient == None:
+            return None
+        gradient_magnitude = math.hypot(gradient[0], gradient[1])
+        self.results.add(gradient_magnitude, now)
+        gust_gradient = round(self.results.max(), 6) # Both rounded alike, so the mean wind is never reported above the gust
+        mean_gradient = min(round(self.results.mean(), 6), gust_gradient) # min() absorbs the running sum's float error
+        bearing = round(math.degrees(math.atan2(gradient[0], gradient[1]))) % 360
+        wind_data = {'Gust km/h': round(gust_gradient * 2070, 1), 'm/s': round(mean_gradient * 575, 1), 'Gust m/s': round(gust_gradient * 575, 1),
+                     'Chill': 0, 'Direction': self.compass_points[round(bearing / 22.5) % 16], 'Bearing': str(bearing)}
+        return wind_data
+
+    def solve(self, now): # The pressure gradient (East, North) in hPa/m, or None
+        fresh = [(self.sources[name]['Position'], self.readings[name][1]) for name in self.readings if now - self.readings[name][0] <= self.max_age]
+        m_xx = m_xy = m_yy = b_x = b_y = 0.0
+        for first in range(len(fresh)):
+            for second in range(first + 1, len(fresh)):
+                d_x = fresh[second][0][0] - fresh[first][0][0]
+                d_y = fresh[second][0][1] - fresh[first][0][1]
+                d_p = fresh[second][1] - fresh[first][1]
+                m_xx += d_x * d_x
+                m_xy += d_x * d_y
+                m_yy += d_y * d_y
+                b_x += d_x * d_p
+                b_y += d_y * d_p
+        trace = m_xx + m_yy
+        if trace == 0: # Fewer than two fresh readings (or co-located monitors)
+            return None
+        determinant = m_xx * m_yy - m_xy * m_xy
+        if determinant > 1e-9 * trace * trace:
+            return ((m_yy * b_x - m_xy * b_y) / determinant, (m_xx * b_y - m_xy * b_x) / determinant)
+        else: # The monitors are in a line, so only the gradient along it can be measured
+            return ((m_xx * b_x + m_xy * b_y) / (trace * trace), (m_xy * b_x + m_yy * b_y) / (trace * trace))
+
+class LuftdatenClientClass(object):
+    # Long-lived Luftdaten client for the Outdoor Enviro Monitor fallback. Requests run on the client's own event loop thread, using one
+    # aiohttp session (and so one connection pool) for the life of the Home Manager, so callers never wait on the network. A request
+    # queries several stations concurrently under one deadline of timeout seconds and, once quorum stations have answered, passes
+    # the median of their readings to the caller's callback. Every station that isn't backing off is queried each time. If fewer than
+    # quorum stations answer, the last good responses (up to cache_ttl seconds old) of the stations that didn't answer make up the
+    # shortfall, but only alongside at least one fresh response, so stale data is never passed on alone. A station that fails is skipped for
+    # backoff seconds, doubled for each further consecutive failure, up to max_backoff seconds
+    def __init__(self, timeout, cache_ttl, quorum, backoff, max_backoff):
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.quorum = quorum
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.loop = None
+        self.session = None
+        self.cache = {} # Sensor ID -> (capture time, captured data)
+        self.failures = {} # Sensor ID -> {'Count': consecutive failures, 'Retry Time': time before which the station is skipped}
+        self.in_flight = set() # Station sets with a request under way
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='Luftdaten Client', daemon=True).start()
+
+    def stop(self):
+        if self.loop is not None and self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result(timeout=5)
+
+    def request(self, sensor_ids, callback): # Returns immediately. callback(captured_data) is called on the client thread if data arrives
+        request_key = tuple(sensor_ids)
+        with self.lock:
+            if request_key in self.in_flight: # Don't queue up behind a request that's still waiting for its deadline
+                return
+            self.in_flight.add(request_key)
+        self.start()
+        asyncio.run_coroutine_threadsafe(self.fetch(request_key, callback), self.loop)
+
+    async def fetch(self, request_key, callback):
+        try:
+            if self.session is None:
+                self.session = aiohttp.ClientSession()
+            now = time.time()
+            responses = []
+            stations = [sensor_id for sensor_id in request_key if now >= self.failures.get(sensor_id, {'Retry Time': 0})['Retry Time']]
+            if not stations:
+                print('Luftdaten Error, No Outdoor Enviro Data Available: all stations are backing off after failures')
+                return
+            quorum = min(self.quorum, len(request_key))
+            answered = set()
+            tasks = {asyncio.ensure_future(self.get_data(sensor_id)): sensor_id for sensor_id in stations}
+            deadline = self.loop.time() + self.timeout
+            pending = set(tasks)
+            while pending and len(responses) < quorum:
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    sensor_id = tasks[task]
+                    captured_data = None if task.exception() is not None else task.result()
+                    if captured_data is None:
+                        self.record_failure(sensor_id, task.exception())
+                    else:
+                        self.failures.pop(sensor_id, None)
+                        self.cache[sensor_id] = (time.time(), captured_data)
+                        responses.append(captured_data)
+                        answered.add(sensor_id)
+            for task in pending:
+                task.cancel()
+                if len(responses) < quorum: # Only a station that missed the deadline counts as failing, not one cut off by the quorum
+                    self.record_failure(tasks[task], 'no response within ' + str(self.timeout) + ' seconds')
+            fresh_count = len(responses)
+            if responses: # Make up a shortfall with the last good responses of the stations that didn't answer
+                for sensor_id in request_key:
+                    if len(responses) >= quorum:
+                        break
+                    cached = self.cache.get(sensor_id)
+                    if sensor_id not in answered and cached is not None and time.time() - cached[0] < self.cache_ttl:
+                        responses.append(cached[1])
+            if responses:
+                captured_data = {reading: statistics.median(response[reading] for response in responses) for reading in responses[0]}
+                print('Luftdaten Data Captured from', fresh_count, 'of', len(request_key), 'stations, with', len(responses) - fresh_count,
+                      'last good responses. Median PM2.5:', captured_data['P2.5'], 'ug/m3, PM10:', captured_data['P10'], 'ug/m3')
+                callback(captured_data)
+            else:
+                print('Luftdaten Error, No Outdoor Enviro Data Available: no station answered')
+        except Exception as e:
+            print('Luftdaten Error, No Outdoor Enviro Data Available:', e)
+        finally:
+            with self.lock:
+                self.in_flight.discard(request_key)
+
+    def record_failure(self, sensor_id, reason):
+        failure = self.failures.setdefault(sensor_id, {'Count': 0, 'Retry Time': 0})
+        failure['Count'] += 1
+        backoff = min(self.backoff * 2 ** (failure['Count'] - 1), self.max_backoff)
+        failure['Retry Time'] = time.time() + backoff
+        print('Luftdaten station', sensor_id, 'failed', failure['Count'], 'times in a row (' + str(reason) + '). Skipping it for', backoff, 'seconds')
+
+    async def get_data(self, sensor_id):
+        data = Luftdaten(sensor_id, self.loop, self.session)
+        await data.get_data()
+        if not await data.validate_sensor():
+            print("Station is not available:", data.sensor_id)
+            return None
+        if data.values and data.meta:
+            # Print the sensor values
+            #print("Sensor values:", data.values)
+            # Print the coordinates for the sensor
+            #print("Location:", data.meta['latitude'], data.meta['longitude'])
+            return {"P2.5": data.values["P2"], "P10": data.values["P1"], "P1": 0}
+        return None
+
 class EnviroClass(object):
     def __init__(self, name, enviro_config):
         #print ('Created Enviro Instance', name, enviro_config)
@@ -942,149 +1851,77 @@ class EnviroClass(object):
         self.PM2_5_alert_level = 35
         self.max_aqi = 1
         self.enviro_config = enviro_config
-        self.max_CO2 = 0
+        self.CO2_peak = PeakTrackerClass(mgr.enviro_CO2_peak_window, mgr.enviro_CO2_peak_log_interval)
+        self.CO2_peak_log_time = 0
         self.CO2_threshold = self.air_reading_bands['CO2'][2]
+        self.aqi_engine = AqiEngineClass(self.air_reading_bands)
+        # Homebridge gas readings are converted from ppm to ug/m3 (Oxi) or mg/m3 (Red and NH3) and clamped to the HAP limit of 1000
+        self.homebridge_conversions = {'Oxi': {'Factor': 1000 * 46/24.45, 'Round': 0, 'Clamp': 1000},
+                                       'Red': {'Factor': 28/24.45, 'Round': 2, 'Clamp': 1000},
+                                       'NH3': {'Factor': 17/24.45, 'Round': 2, 'Clamp': 1000}}
+        self.homebridge_excluded_readings = ['Noise'] # Non AQI readings that are only sent to Domoticz
+        self.processing_plans = {'Gas': self.compile_processing_plan(self.valid_enviro_aqi_readings, self.enviro_config['Capture Non AQI'], True),
+                                 'No Gas': self.compile_processing_plan(self.valid_enviro_aqi_readings_no_gas, self.enviro_config['Capture Non AQI'], False),
+                                 'Luftdaten': self.compile_processing_plan(self.valid_luftdaten_readings, self.enviro_config['Capture Non AQI'], False)}
         self.latest = {}
+
+    def compile_processing_plan(self, aqi_readings, capture_non_aqi, gas_readings):
+        # Decides once, at start-up, what happens to each reading that a message can carry, so that capture_readings just follows the plan.
+        # Readings that aren't in the plan are ignored
+        steps = {}
+        for reading in aqi_readings:
+            steps[reading] = {'Domoticz': True, 'Homebridge': True, 'Conversion': self.homebridge_conversions.get(reading),
+                              'CO2 Peak': reading == 'CO2'}
+        if capture_non_aqi:
+            for reading in self.valid_enviro_non_aqi_readings:
+                steps[reading] = {'Domoticz': True, 'Homebridge': reading not in self.homebridge_excluded_readings, 'Conversion': None,
+                                  'CO2 Peak': False}
+        return {'Steps': steps, 'AQI Readings': frozenset(aqi_readings), 'Gas Readings': gas_readings}
         
     def capture_readings(self, source, parsed_json):
         #print('Capturing Enviro Readings', source, parsed_json)
         self.latest = parsed_json
         if source == 'Luftdaten':
-            valid_source = True
-            gas_readings = False
-            valid_aqi_readings = self.valid_luftdaten_readings
+            plan = self.processing_plans['Luftdaten']
         elif source == 'Enviro':
-            valid_source = True
-            if 'Gas Calibrated' in parsed_json: # Only capture gas readings if the sensors have been calibrated
-                if parsed_json['Gas Calibrated']:
-                    gas_readings = True
-                    valid_aqi_readings = self.valid_enviro_aqi_readings
-                else:
-                    gas_readings = False
-                    valid_aqi_readings = self.valid_enviro_aqi_readings_no_gas
-            else:
-                gas_readings = True # This is for backwards compatibility. Enviro Monitors prior to 3.55 didn't have a 'Gas Calibrated' key
-                valid_aqi_readings = self.valid_enviro_aqi_readings
+            # Only capture gas readings if the sensors have been calibrated. Enviro Monitors prior to 3.55 didn't have a 'Gas Calibrated' key
+            plan = self.processing_plans['Gas' if parsed_json.get('Gas Calibrated', True) else 'No Gas']
         else:
-            valid_source = False
-        if valid_source:
-            individual_aqi = {}
+            plan = None
+        if plan != None:
+            gas_readings = plan['Gas Readings']
+            self.max_aqi, individual_aqi = self.aqi_engine.score(parsed_json, plan['AQI Readings'])
+            #print(self.name, 'AQI is at Level', self.max_aqi, 'Individual AQI:', individual_aqi)
             homebridge_data = {}
             domoticz_data = {}
-            self.max_aqi = 0
-            valid_source = False
-            for reading in parsed_json: # Check each reading
-                if reading in valid_aqi_readings: # Analyse AQI Readings
-                    individual_aqi[reading] = 0
-                    for boundary in range(4): # Check each reading against its AQI boundary
-                        if parsed_json[reading] >= self.air_reading_bands[reading][boundary]: # Find the boundary that the reading has met or exceeded 
-                            aqi = boundary + 1 # Convert the boundary to the AQI reading
-                            individual_aqi[reading] = aqi
-                            #print('Search Max AQI', aqi, reading, self.air_reading_bands[reading])
-                            if aqi > self.max_aqi: # If this reading has the maximum AQI so far, make it the max AQI
-                                self.max_aqi = aqi
-                                max_reading = reading
-                            #print('Air Quality Component:', reading, 'has an AQI Level of', aqi, 'with a reading of', round(parsed_json[reading],0))
-                    if self.max_aqi > 0:
-                        #print('AQI is at Level', self.max_aqi, 'due to', max_reading, 'with a reading of', round(parsed_json[max_reading],0))
-                        pass
+            steps = plan['Steps']
+            for reading in parsed_json: # Follow the plan for each reading
+                step = steps.get(reading)
+                if step == None:
+                    continue # Ignore other readings
+                value = parsed_json[reading]
+                if step['Domoticz']:
+                    domoticz_data[reading] = value
+                if step['Homebridge']:
+                    conversion = step['Conversion']
+                    if conversion == None:
+                        homebridge_data[reading] = value
                     else:
-                        #print('AQI is at Level 0')
-                        pass
-                    domoticz_data[reading] = parsed_json[reading]
-                    # Convert ppm to ug/m3 for Enviro homebridge gases data (except for Red and NH3, which is in mg/m3)
-                    if reading == 'Oxi':
-                        homebridge_data[reading] = round(1000* parsed_json[reading] * 46/24.45, 0)
-                        if homebridge_data[reading] > 1000: # Set max NO2 Level to 1000 ug/m3 (HAP Limit)
-                            homebridge_data[reading] = 1000
-                    elif reading == 'Red':
-                        homebridge_data[reading] = round(parsed_json[reading] * 28/24.45, 2)
-                        if homebridge_data[reading] > 1000: # Set max Red Level to 1000 mg/m3 (HAP Limit)
-                            homebridge_data[reading] = 1000
-                    elif reading == 'NH3':
-                        homebridge_data[reading] = round(parsed_json[reading] * 17/24.45, 2)
-                        if homebridge_data[reading] > 1000: # Set max NH3 Level to 1000 mg/m3 (HAP Limit)
-                            homebridge_data[reading] = 1000
-                    else:
-                        homebridge_data[reading] = parsed_json[reading]
-                    if reading == 'CO2':
-                        if parsed_json[reading] > self.max_CO2:
-                            print('Old Max CO2:', self.max_CO2)
-                            self.max_CO2 = parsed_json[reading]
-                            print('New Max CO2:', self.max_CO2)
-                            mgr.log_key_states("Enviro Max CO2 Change")
-                elif reading in self.valid_enviro_non_aqi_readings:
-                    if self.enviro_config['Capture Non AQI']:
-                        if reading != 'Noise': # Don't capture noise readings in homebridge
-                            homebridge_data[reading] = parsed_json[reading]
-                        domoticz_data[reading] = parsed_json[reading]
-                else:
-                    pass # Ignore other readings
+                        homebridge_data[reading] = min(round(value * conversion['Factor'], conversion['Round']), conversion['Clamp'])
+                if step['CO2 Peak']:
+                    self.CO2_peak.add(value)
+                    if time.time() - self.CO2_peak_log_time >= mgr.enviro_CO2_peak_log_interval: # Throttle key state log writes
+                        self.CO2_peak_log_time = time.time()
+                        mgr.log_key_states("Enviro CO2 Peak Update")
             #print(self.name, 'Air Quality Update. Overall AQI:', self.max_aqi, 'Individual AQI:', individual_aqi)
-            if self.name in mgr.enviro_wind_config:
-                #print("Calculating Domoticz Wind for", self.name, "with a reading of", domoticz_data['Bar'][0], "hPa and an offset of", mgr.enviro_wind_config[self.name]['Offset'], "hPa")
-                mgr.enviro_wind_config[self.name]['Air Pressure'] = domoticz_data['Bar'][0] + mgr.enviro_wind_config[self.name]['Offset']
-                if mgr.previous_enviro_wind_source != self.name and mgr.previous_enviro_wind_source != None: #Ensure that there are readings from two sources
-                    valid_wind_reading = True
-                else:
-                    valid_wind_reading = False
+            mgr.sensor_history.record_readings(self.name, domoticz_data)
+            mgr.sensor_history.record(self.name, 'AQI', self.max_aqi)
+            if self.name in mgr.enviro_wind_config['Sources']:
+                #print("Calculating Domoticz Wind for", self.name, "with a reading of", domoticz_data['Bar'][0], "hPa")
+                wind_data = mgr.wind_engine.update(self.name, domoticz_data['Bar'][0])
+                if wind_data == None:
                     print("No valid wind reading received")
-                mgr.previous_enviro_wind_source = self.name
-                if valid_wind_reading:
-                    wind_data = {'Gust km/h': 0, 'm/s': 0, 'Gust m/s': 0, 'Chill': 0, 'Direction': '', 'Bearing': 0}
-                    current_air_pressure_delta = 0
-                    valid_orientation = True
-                    for enviro in mgr.enviro_wind_config:
-                        if mgr.enviro_wind_config[enviro]['Direction'] == 'West':
-                            enviro_orientation = 'East West'
-                            current_air_pressure_delta = current_air_pressure_delta - mgr.enviro_wind_config[enviro]['Air Pressure']
-                        elif mgr.enviro_wind_config[enviro]['Direction'] == 'East':
-                            enviro_orientation = 'East West'
-                            current_air_pressure_delta = current_air_pressure_delta + mgr.enviro_wind_config[enviro]['Air Pressure']
-                        elif mgr.enviro_wind_config[enviro]['Direction'] == 'North':
-                            enviro_orientation = 'North South'
-                            current_air_pressure_delta = current_air_pressure_delta - mgr.enviro_wind_config[enviro]['Air Pressure']
-                        elif mgr.enviro_wind_config[enviro]['Direction'] == 'South':
-                            enviro_orientation = 'North South'
-                            current_air_pressure_delta = current_air_pressure_delta + mgr.enviro_wind_config[enviro]['Air Pressure']
-                        else:
-                            valid_orientation = False
-                    if valid_orientation:
-                        if enviro_orientation == 'East West':
-                            if current_air_pressure_delta >= 0:
-                                wind_data['Direction'] = 'E'
-                                wind_data['Bearing'] = '90'
-                            else:
-                                wind_data['Direction'] = 'W'
-                                wind_data['Bearing'] = '270'
-                        else:
-                            if current_air_pressure_delta >= 0:
-                                wind_data['Direction'] = 'N'
-                                wind_data['Bearing'] = '0'
-                            else:
-                                wind_data['Direction'] = 'S'
-                                wind_data['Bearing'] = '180'
-                        current_air_pressure_delta = round(current_air_pressure_delta, 2)
-                        #print("Current Delta", current_air_pressure_delta)
-                if valid_wind_reading and valid_orientation:
-                    # Calculate mean wind over ten measurements, calulate the mean and the highest reading for the gust level
-                    for pointer in range(9, 0, -1): # Move previous temperatures one position in the list to prepare for new temperature to be recorded 
-                        mgr.enviro_wind_results[pointer] = mgr.enviro_wind_results[pointer - 1]
-                    mgr.enviro_wind_results[0] = abs(current_air_pressure_delta)
-                    valid_reading_count = 0
-                    for pointer in range(0, 10):
-                        if mgr.enviro_wind_results[pointer] != None:
-                            valid_reading_count += 1
-                    #print("Valid Reading Count", valid_reading_count)
-                    reading_sum = 0
-                    for pointer in range(0, valid_reading_count):
-                        reading_sum = reading_sum + mgr.enviro_wind_results[pointer]
-                    air_pressure_delta = round(reading_sum/valid_reading_count, 3)
-                    gust_air_pressure_delta = max(mgr.enviro_wind_results[0:valid_reading_count]) #Replace latest wind reading with maximum over the reporting period for the Gust reading
-                    #print("Enviro Wind Results", mgr.enviro_wind_results)
-                    wind_data['Gust km/h'] = round(gust_air_pressure_delta * 2070 / mgr.enviro_wind_distance, 1) #Convert air pressure delta to km/h
-                    wind_data['m/s'] = round(air_pressure_delta * 575 / mgr.enviro_wind_distance, 1) #Convert air pressure delta to m/s
-                    wind_data['Gust m/s'] = round(gust_air_pressure_delta * 575 / mgr.enviro_wind_distance, 1)
+                else:
                     wind_data['Chill'] = round(13.12 + 0.6215 * parsed_json['Temp'] - 11.37 * pow(wind_data['Gust km/h'], 0.16) + 0.3965 * parsed_json['Temp'] * pow(wind_data['Gust km/h'], 0.16), 1)
                     #print("Wind Data", wind_data)
                     domoticz_data['Wind'] = wind_data
@@ -1094,72 +1931,270 @@ class EnviroClass(object):
             if self.enviro_config['Homebridge Display']: # Only update Homebridge if enabled
                 #print(self.name, 'Homebridge Data:', homebridge_data)
                 homebridge.update_enviro_aqi(self.name, self.enviro_config, self.max_aqi, homebridge_data, individual_aqi,
-                                             self.PM2_5_alert_level, gas_readings, self.max_CO2, self.CO2_threshold)
+                                             self.PM2_5_alert_level, gas_readings, self.CO2_peak.peak(), self.CO2_threshold)
 
-    def capture_luftdaten_data(self, sensor_id): # Call this if there has been no sensor data for 15 minutes
-        try:
-            async def main():
-                #try:
-                async with aiohttp.ClientSession() as session:
-                    data = Luftdaten(sensor_id, loop, session)
-                    await data.get_data()
-                    if not await data.validate_sensor():
-                        print("Station is not available:", data.sensor_id)
-                        return "Station is not available", {}
-                    if data.values and data.meta:
-                        # Print the sensor values
-                        #print("Sensor values:", data.values)
-                        # Print the coordinates for the sensor
-                        #print("Location:", data.meta['latitude'], data.meta['longitude'])
-                        captured_data = {"P2.5": data.values["P2"], "P10": data.values["P1"], "P1": 0}
-                        print('Luftdaten Data Captured. PM2.5:', captured_data['P2.5'],'ug/m3, PM10:', captured_data['P10'], 'ug/m3')
-                        return "Data Captured", captured_data
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            try:
-                message, captured_data = loop.run_until_complete(main())
-            finally:
-                loop.close()
-            if message == "Data Captured":
-                self.capture_readings('Luftdaten', captured_data)
-        except Exception as e:
-            print('Luftdaten Error, No Outdoor Enviro Data Available:', e)
+    def capture_luftdaten_data(self, sensor_ids): # Call this if there has been no sensor data for 15 minutes. Doesn't wait for the response
+        mgr.luftdaten_client.request(sensor_ids, self.queue_luftdaten_data)
+
+    def queue_luftdaten_data(self, captured_data): # Luftdaten data is handled on the Enviro lane, in turn with the Enviro Monitor messages
+        pipeline.enqueue('Enviro', 'Luftdaten', lambda topic, captured_data: self.capture_readings('Luftdaten', captured_data),
+                         mgr.decode_decoded_payload, captured_data)
             
 class ShellyReadingClass(object):
+    # Aggregates the power (W) and energy total (Wh) readings of every Shelly channel into running totals for each circuit in
+    # mgr.shelly_circuits, and overall. Channels are discovered from their topics. Each reading adjusts the totals by its change from
+    # the channel's previous reading, so a reading costs the same however many channels there are
     def __init__(self):
         print("Started Shelly Class")
-        # map each topic to its channel number (0/1/2)
-        self.power_topics  = {mgr.shelly_power_0_incoming_mqtt_topic: 0,
-                              mgr.shelly_power_1_incoming_mqtt_topic: 1,
-                              mgr.shelly_power_2_incoming_mqtt_topic: 2}
-        self.energy_topics = {mgr.shelly_energy_0_incoming_mqtt_topic: 0,
-                              mgr.shelly_energy_1_incoming_mqtt_topic: 1,
-                              mgr.shelly_energy_2_incoming_mqtt_topic: 2}
-        self.power  = {}          # channel -> latest power (W)
-        self.energy = {}          # channel -> latest energy (Wh)
-        self.energy_seen = set()  # channels received in the current cycle
+        self.channels = {} # (device id, channel) -> {'Power', 'Energy', 'Power Time', 'Live', 'Circuits'}
+        self.circuit_totals = {circuit: {'Power': 0.0, 'Energy': 0.0, 'Sent': False} for circuit in mgr.shelly_circuits}
         self.total_power = 0
         self.total_energy = 0
+        self.channel_found_time = 0 # Time that the last new channel was found
+
+    def add_channel(self, channel_key):
+        circuits = [circuit for circuit in mgr.shelly_circuits
+                    if mgr.shelly_circuits[circuit]['Channels'] == 'All' or channel_key in mgr.shelly_circuits[circuit]['Channels']]
+        print('Found Shelly channel', channel_key, 'in circuits', circuits)
+        channel = {'Power': 0.0, 'Energy': 0.0, 'Energy Seen': False, 'Power Time': 0, 'Live': False, 'Circuits': circuits}
+        self.channels[channel_key] = channel
+        self.channel_found_time = time.time()
+        return channel
+
+    def circuit_ready(self, circuit, now): # Whether every channel of the circuit has been found and has reported its energy total
+        channels = mgr.shelly_circuits[circuit]['Channels']
+        if channels == 'All':
+            found = [channel for channel in self.channels.values() if circuit in channel['Circuits']]
+            expected_channels = mgr.shelly_circuits[circuit].get('Expected Channels')
+            if expected_channels is not None:
+                if len(found) < expected_channels:
+                    return False
+            elif now - self.channel_found_time < mgr.shelly_emit_interval:
+                return False
+        else:
+            found = [self.channels[channel_key] for channel_key in channels if channel_key in self.channels]
+            if len(found) < len(channels):
+                return False
+        return len(found) > 0 and all(channel['Energy Seen'] for channel in found)
 
     def process_reading(self, topic, payload):
+        topic_levels = topic.split('/') # shellies/<device id>/emeter/<channel>/<reading>
+        reading = topic_levels[4]
+        if reading != 'power' and reading != 'total': # e.g. voltage, current or returned energy
+            return
+        channel_key = (topic_levels[1], int(topic_levels[3]))
+        channel = self.channels.get(channel_key)
+        if channel is None:
+            channel = self.add_channel(channel_key)
         value = float(payload)
-        if topic in self.power_topics:
-            self.power[self.power_topics[topic]] = value
-            self.total_power = sum(self.power.values())
-        elif topic in self.energy_topics:
-            channel = self.energy_topics[topic]
-            self.energy[channel] = value
-            self.energy_seen.add(channel)
-            if self.energy_seen == {0, 1, 2}:          # one full set received, any order
-                self.total_power  = sum(self.power.values())
-                self.total_energy = sum(self.energy.values())
-                domoticz.update_electricity_data(self.total_power, self.total_energy)
-                self.energy_seen.clear()
+        if reading == 'power':
+            change = value if not channel['Live'] else value - channel['Power'] # A stale channel's power was taken out of the totals
+            channel['Power'] = value
+            channel['Power Time'] = time.time()
+            channel['Live'] = True
+            self.total_power += change
+            for circuit in channel['Circuits']:
+                self.circuit_totals[circuit]['Power'] += change
+        else:
+            change = value - channel['Energy']
+            channel['Energy'] = value
+            self.total_energy += change
+            for circuit in channel['Circuits']: # A channel found after its circuit was first sent only adds its new use, so the total doesn't jump
+                if channel['Energy Seen'] or not self.circuit_totals[circuit]['Sent']:
+                    self.circuit_totals[circuit]['Energy'] += change
+            if energy_cost is not None and channel['Energy Seen'] and change > 0: # A channel's first total is its whole history, not new use
+                energy_cost.add_energy(change)
+            channel['Energy Seen'] = True
+
+    def emit(self): # Drops stale channels' power from the totals, then sends each ready circuit with a live channel to Domoticz
+        now = time.time()
+        stale_time = now - mgr.shelly_channel_timeout
+        for channel_key, channel in self.channels.items():
+            if channel['Live'] and channel['Power Time'] < stale_time:
+                print('Shelly channel', channel_key, 'is stale. Leaving its power out of the totals')
+                channel['Live'] = False
+                self.total_power -= channel['Power']
+                for circuit in channel['Circuits']:
+                    self.circuit_totals[circuit]['Power'] -= channel['Power']
+        for circuit, totals in self.circuit_totals.items():
+            if not totals['Sent'] and not self.circuit_ready(circuit, now):
+                continue
+            if any(channel['Live'] and circuit in channel['Circuits'] for channel in self.channels.values()):
+                domoticz.update_electricity_data(mgr.shelly_circuits[circuit]['idx'], totals['Power'], totals['Energy'])
+                totals['Sent'] = True
+        if energy_cost is not None and mgr.energy_cost_idx != None:
+            domoticz.update_energy_cost(mgr.energy_cost_idx, energy_cost.summary()['Day']['Cost'])
+
+class EnergyCostClass(object):
+    # Accumulates electricity use (kWh) and cost for today and this month, per tariff band, from the Shelly energy readings. The tariff
+    # band is worked out once per hour, for the hour segment that the readings fall in, so each reading is only a comparison and a few adds
+    def __init__(self, tariff_name, tariff_rates):
+        self.tariff_name = tariff_name # Returns the tariff band name at a local datetime
+        self.tariff_rates = tariff_rates
+        self.lock = threading.Lock() # Readings arrive on the Shelly lane. Summaries are read for TRMNL and the key state log
+        self.segment_end = 0 # Time that the current hour segment ends
+        self.band = None
+        self.rate = 0
+        self.day = {'Date': '', 'Bands': {}}
+        self.month = {'Month': '', 'Bands': {}}
+
+    def start_segment(self, now):
+        dt = datetime.fromtimestamp(now)
+        segment_start = dt.replace(minute=0, second=0, microsecond=0)
+        self.segment_end = (segment_start + timedelta(hours=1)).timestamp()
+        self.band = self.tariff_name(dt)
+        self.rate = self.tariff_rates[self.band]
+        if self.day['Date'] != dt.strftime('%Y-%m-%d'):
+            self.day = {'Date': dt.strftime('%Y-%m-%d'), 'Bands': {}}
+        if self.month['Month'] != dt.strftime('%Y-%m'):
+            self.month = {'Month': dt.strftime('%Y-%m'), 'Bands': {}}
+
+    def add_energy(self, watt_hours, now=None):
+        if now is None:
+            now = time.time()
+        new_segment = False
+        with self.lock:
+            if now >= self.segment_end:
+                self.start_segment(now)
+                new_segment = True
+            kilowatt_hours = watt_hours / 1000
+            cost = kilowatt_hours * self.rate
+            for totals in (self.day['Bands'], self.month['Bands']):
+                band_totals = totals.get(self.band)
+                if band_totals is None:
+                    band_totals = totals[self.band] = {'kWh': 0.0, 'Cost': 0.0}
+                band_totals['kWh'] += kilowatt_hours
+                band_totals['Cost'] += cost
+        if new_segment: # Logged at most once an hour, and outside the lock because building the key states takes a summary
+            mgr.log_key_states('Energy Cost Update')
+
+    def summary(self): # Today's and this month's kWh and cost, overall and per band. Read only, as it's called while the key states are built
+        dt = datetime.now()
+        with self.lock:
+            result = {}
+            periods = (('Day', self.day['Date'], self.day['Bands'], dt.strftime('%Y-%m-%d')),
+                       ('Month', self.month['Month'], self.month['Bands'], dt.strftime('%Y-%m')))
+            for period, recorded_period, totals, current_period in periods:
+                if recorded_period != current_period: # No use recorded yet in this period
+                    totals = {}
+                bands = {band: {'kWh': round(values['kWh'], 3), 'Cost': round(values['Cost'], 4)} for band, values in totals.items()}
+                result[period] = {'Period': current_period, 'Bands': bands,
+                                  'kWh': round(sum(values['kWh'] for values in totals.values()), 3),
+                                  'Cost': round(sum(values['Cost'] for values in totals.values()), 4)}
+            return result
+
+    def restore(self, summary):
+        with self.lock:
+            self.day = {'Date': summary['Day']['Period'], 'Bands': {band: dict(values) for band, values in summary['Day']['Bands'].items()}}
+            self.month = {'Month': summary['Month']['Period'], 'Bands': {band: dict(values) for band, values in summary['Month']['Bands'].items()}}
+            self.segment_end = 0 # The next reading starts a new segment, rolling over the day or month if they've passed
+
+class HttpCacheClass(object):
+    # A small HTTP cache for GET requests. A response is reused without a request until it expires (Cache-Control max-age, or Expires),
+    # then revalidated with a conditional request (If-None-Match / If-Modified-Since), so an unchanged response costs a 304. The cache
+    # is saved to file_name so that a restart doesn't need fresh downloads, and its last response is served if a request fails
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock() # Requests run concurrently from the TRMNL fetch threads
+        self.counts = {'Hits': 0, 'Misses': 0, 'Revalidated': 0, 'Stale': 0}
+        self.entries = {} # URL -> {'Body', 'ETag', 'Last-Modified', 'Expires'}
+        try:
+            with open(self.file_name, 'r') as f:
+                self.entries = json.loads(f.read())
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print('HTTP Cache load error:', e)
+
+    def get(self, url, headers, timeout): # Returns the response text. Raises an exception if there's neither a response nor a cached one
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None and time.time() < entry['Expires']:
+                self.counts['Hits'] += 1
+                return entry['Body']
+        request_headers = dict(headers)
+        if entry is not None:
+            if entry['ETag']:
+                request_headers['If-None-Match'] = entry['ETag']
+            if entry['Last-Modified']:
+                request_headers['If-Modified-Since'] = entry['Last-Modified']
+        try:
+            response = requests.get(url, headers=request_headers, timeout=timeout)
+            if response.status_code == 304 and entry is not None:
+                body = entry['Body']
+                count = 'Revalidated'
+            else:
+                response.raise_for_status()
+                body = response.text
+                count = 'Misses'
+        except Exception as e:
+            if entry is None:
+                raise
+            print('HTTP Cache: serving stale response for', url, 'after error:', e)
+            with self.lock:
+                self.counts['Stale'] += 1
+            return entry['Body']
+        with self.lock:
+            self.counts[count] += 1
+            expires = self.expiry_time(response.headers)
+            if expires is None: # no-store
+                self.entries.pop(url, None)
+            else:
+                self.entries[url] = {'Body': body, 'Expires': expires,
+                                     'ETag': response.headers.get('ETag', entry['ETag'] if entry is not None else None),
+                                     'Last-Modified': response.headers.get('Last-Modified', entry['Last-Modified'] if entry is not None else None)}
+            self.save()
+        return body
+
+    def expiry_time(self, response_headers): # When a response stops being fresh, or None if it mustn't be stored
+        now = time.time()
+        directives = {}
+        for directive in response_headers.get('Cache-Control', '').split(','):
+            name, _, value = directive.strip().partition('=')
+            directives[name.lower()] = value.strip('"')
+        if 'no-store' in directives:
+            return None
+        if 'no-cache' in directives:
+            return now # Always revalidate
+        try:
+            age = float(response_headers.get('Age', 0))
+        except ValueError:
+            age = 0
+        if 'max-age' in directives:
+            try:
+                return now + float(directives['max-age']) - age
+            except ValueError:
+                return now
+        if 'Expires' in response_headers:
+            try:
+                expires = parsedate_to_datetime(response_headers['Expires']).timestamp()
+                if 'Date' in response_headers: # Judge Expires against the server's clock, not ours
+                    expires = now + expires - parsedate_to_datetime(response_headers['Date']).timestamp()
+                return expires
+            except Exception: # An invalid Expires means already expired
+                return now
+        return now # No freshness information, so revalidate every time
+
+    def save(self): # Called with the lock held
+        try:
+            temp_file_name = self.file_name + '.tmp'
+            with open(temp_file_name, 'w') as f:
+                f.write(json.dumps(self.entries))
+            os.replace(temp_file_name, self.file_name)
+        except Exception as e:
+            print('HTTP Cache save error:', e)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.counts, Entries=len(self.entries))
+
+class GetCTag(BaseElement): # CalendarServer's collection tag, which changes whenever anything in a calendar changes
+    tag = '{http://calendarserver.org/ns/}getctag'
 
 class TrmnlClass(object):
     
     def __init__(self, plugin_uuid, api_key, geohash, caldav_url, caldav_user, caldav_pass, caldav_calendar, caldav_timezone,
-                 peak_hours, tariff_rates, location):
+                 peak_hours, tariff_rates, location, bom_cache_file_name):
         print("Started TRMNL Class")
         self.plugin_uuid = plugin_uuid
         self.api_key = api_key
@@ -1172,21 +2207,50 @@ class TrmnlClass(object):
         self.peak_hours = peak_hours
         self.tariff_rates = tariff_rates
         self.location = location
+        self.bom_cache = HttpCacheClass(bom_cache_file_name) # BOM responses, reused until BOM says they've expired
+        # A push is skipped if its payload hasn't materially changed since the last successful push, unless that was push_max_age
+        # seconds ago. Fields in push_ignored_fields (the clock, the fields the markup doesn't show, and the formatted electricity fields)
+        # don't count, and numeric fields ending in a push_quantisation suffix only count when they move to a different step. The
+        # electricity power is hashed as a number instead, so that it (and the cost per hour derived from it) only counts in whole steps
+        self.push_max_age = 3600
+        self.push_ignored_fields = ['updated', 'station', 'rear_balcony_temp_min_24h', 'rear_balcony_temp_max_24h',
+                                    'electricity_cost_today', 'electricity_cost_month', 'electricity_kw', 'electricity_cost_ph']
+        self.push_quantisation = {'_temp': 0.5, '_dewpoint': 0.5, '_pm25': 1, '_kw': 0.1}
+        self.last_push_hash = None
+        self.last_push_time = 0
+        self.push_counts = {'Pushed': 0, 'Skipped': 0}
+        # The display's sources are fetched concurrently. Any source that hasn't answered within gather_deadline seconds (or fails)
+        # is shown with its last good data. A source whose previous fetch is still running isn't fetched again until it finishes
+        self.gather_deadline = 20
+        self.sources = {'Observations': (lambda: self._fetch_bom("observations"), {}), 'Forecast': (lambda: self._fetch_bom("forecasts/hourly"), []),
+                        'Calendar': (self._get_calendar_events, [])} # Source -> (fetcher, data to use before the first good fetch)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.sources), thread_name_prefix='TRMNL Fetch')
+        self.source_futures = {}
+        self.last_good = {source: self.sources[source][1] for source in self.sources}
+        self.stage_timings = {} # Stage -> seconds taken by its last run
+        # The CalDAV client and calendar are found once and kept. Events from today to calendar_lookahead_days ahead are cached and only
+        # re-fetched when the calendar's sync-token or ctag changes (or the cached days no longer cover today)
+        self.calendar_lookahead_days = 7
+        self.caldav_client = None
+        self.caldav_calendar_object = None
+        self.calendar_cache = {'Token': None, 'Start': None, 'End': None, 'Events': []}
+        self.calendar_fetch_count = 0
 
     def _fetch_bom(self, endpoint):
         url = f"https://api.weather.bom.gov.au/v1/locations/{self.geohash}/{endpoint}"
         weather_headers = {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36",
                                               "Accept": "application/json", "Referer": "https://www.bom.gov.au/"}
         try:
-            response = requests.get(url, headers=weather_headers, timeout=30)
-            response.raise_for_status()
-            return response.json().get("data", {} if endpoint == "observations" else [])
+            return json.loads(self.bom_cache.get(url, weather_headers, 30)).get("data", {} if endpoint == "observations" else [])
         except Exception as e:
             print("TRMNL: BOM fetch error:", e)
-            return {} if endpoint == "observations" else []
+            return None
 
     def _get_tariff(self):
-        dt = datetime.now()
+        name = self._tariff_name(datetime.now())
+        return name, self.tariff_rates[name]
+
+    def _tariff_name(self, dt): # The tariff band at a local time. Bands only change on the hour
         hour = dt.hour
         is_weekend = dt.weekday() >= 5
         if hour < 7 or hour >= 22:
@@ -1196,7 +2260,7 @@ class TrmnlClass(object):
         else:
             peak = self.peak_hours.get(dt.month)
             name = "Peak" if peak and peak[0] <= hour < peak[1] else "Shoulder"
-        return name, self.tariff_rates[name]
+        return name
 
     def _get_sun_times(self):
         try:
@@ -1219,55 +2283,89 @@ class TrmnlClass(object):
                 fixed.append(line)
         return '\r\n'.join(fixed)
         
-    def _get_calendar_events(self):
-        """Return up to 5 of today's events as [{'time': str, 'title': str}, ...]."""
-        tz = pytz.timezone(self.caldav_timezone)
-        try:
+    def _get_calendar(self): # The configured calendar, found on first use and then kept. None if it isn't found
+        if self.caldav_calendar_object is None:
             client = caldav.DAVClient(url=self.caldav_url, username=self.caldav_user, password=self.caldav_pass)
             principal = client.principal()
-            target_cal = None
             for cal in principal.calendars():
                 if cal.get_display_name() == self.caldav_calendar:
-                    target_cal = cal
+                    self.caldav_client = client
+                    self.caldav_calendar_object = cal
+                    print('TRMNL: Found calendar', self.caldav_calendar, 'at', cal.url)
                     break
+        return self.caldav_calendar_object
+
+    def _calendar_change_token(self, calendar): # One PROPFIND. None if the server offers neither a sync-token nor a ctag
+        properties = calendar.get_properties([dav.SyncToken(), GetCTag()])
+        token = (properties.get(dav.SyncToken.tag), properties.get(GetCTag.tag))
+        return token if token != (None, None) else None
+
+    def _fetch_calendar_window(self, calendar, window_start, window_end, tz): # Parses every event in the window, with its start and end
+        self.calendar_fetch_count += 1
+        events = calendar.search(start=window_start, end=window_end, event=True, expand=True)
+        result = []
+        for event in events:
+            try:
+                try:
+                    vevent = event.vobject_instance.vevent
+                except Exception:
+                    # caldav parses eagerly and can't hand us clean text for this event (iCloud emitted an
+                    # unescaped newline, e.g. a multi-line address). Re-fetch the raw ICS directly and repair it.
+                    resp = requests.get(requote_uri(str(event.url)),
+                                        auth=(self.caldav_user, self.caldav_pass), timeout=10)
+                    vevent = vobject.readOne(self._sanitize_ics(resp.text)).vevent
+                summary = str(vevent.summary.value) if hasattr(vevent, 'summary') else ''
+                dtstart = vevent.dtstart.value
+                dtend = vevent.dtend.value if hasattr(vevent, 'dtend') else None
+                if isinstance(dtstart, date) and not isinstance(dtstart, datetime):
+                    time_str = 'All day'
+                    sort_key = (0, datetime.min.replace(tzinfo=tz))
+                    start = tz.localize(datetime.combine(dtstart, datetime.min.time()))
+                    end = tz.localize(datetime.combine(dtend, datetime.min.time())) if dtend is not None else start + timedelta(days=1)
+                else:
+                    if dtstart.tzinfo is None:
+                        dtstart = tz.localize(dtstart)
+                    dtstart  = dtstart.astimezone(tz)
+                    time_str = dtstart.strftime('%-I:%M %p')
+                    sort_key = (1, dtstart)
+                    start = dtstart
+                    if dtend is not None:
+                        end = tz.localize(dtend) if dtend.tzinfo is None else dtend.astimezone(tz)
+                    elif hasattr(vevent, 'duration'):
+                        end = start + vevent.duration.value
+                    else:
+                        end = start
+                result.append({'time': time_str, 'title': summary, '_sk': sort_key, 'Start': start, 'End': end})
+            except Exception as ev_ex:
+                print(f'TRMNL: Skipping calendar event: {ev_ex}')
+                continue
+        return result
+
+    def _get_calendar_events(self):
+        """Return up to 5 of today's events as [{'time': str, 'title': str}, ...], or None on error."""
+        tz = pytz.timezone(self.caldav_timezone)
+        try:
+            target_cal = self._get_calendar()
             if target_cal is None:
                 print(f'TRMNL: Calendar "{self.caldav_calendar}" not found')
                 return []
             now_local   = datetime.now(tz)
-            today_start = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
-            today_end   = today_start + timedelta(days=1)
-            events = target_cal.search(start=today_start, end=today_end, event=True, expand=True)
-            result = []
-            for event in events:
-                try:
-                    try:
-                        vevent = event.vobject_instance.vevent
-                    except Exception:
-                        # caldav parses eagerly and can't hand us clean text for this event (iCloud emitted an
-                        # unescaped newline, e.g. a multi-line address). Re-fetch the raw ICS directly and repair it.
-                        resp = requests.get(requote_uri(str(event.url)),
-                                            auth=(self.caldav_user, self.caldav_pass), timeout=10)
-                        vevent = vobject.readOne(self._sanitize_ics(resp.text)).vevent
-                    summary = str(vevent.summary.value) if hasattr(vevent, 'summary') else ''
-                    dtstart = vevent.dtstart.value
-                    if isinstance(dtstart, date) and not isinstance(dtstart, datetime):
-                        time_str = 'All day'
-                        sort_key = (0, datetime.min.replace(tzinfo=tz))
-                    else:
-                        if dtstart.tzinfo is None:
-                            dtstart = tz.localize(dtstart)
-                        dtstart  = dtstart.astimezone(tz)
-                        time_str = dtstart.strftime('%-I:%M %p')
-                        sort_key = (1, dtstart)
-                    result.append({'time': time_str, 'title': summary, '_sk': sort_key})
-                except Exception as ev_ex:
-                    print(f'TRMNL: Skipping calendar event: {ev_ex}')
-                    continue
+            today_start = tz.localize(datetime.combine(now_local.date(), datetime.min.time()))
+            today_end   = tz.localize(datetime.combine(now_local.date() + timedelta(days=1), datetime.min.time()))
+            token = self._calendar_change_token(target_cal)
+            cache = self.calendar_cache
+            if token is None or token != cache['Token'] or cache['Start'] is None or not (cache['Start'] <= today_start and today_end <= cache['End']):
+                window_end = tz.localize(datetime.combine(now_local.date() + timedelta(days=self.calendar_lookahead_days), datetime.min.time()))
+                self.calendar_cache = cache = {'Token': token, 'Start': today_start, 'End': window_end,
+                                               'Events': self._fetch_calendar_window(target_cal, today_start, window_end, tz)}
+            # Events that overlap today (a zero length event counts if it's at or after the start of today)
+            result = [e for e in cache['Events'] if e['Start'] < today_end and (e['End'] > today_start or e['Start'] >= today_start)]
             result.sort(key=lambda e: e['_sk'])
             return [{'time': e['time'], 'title': e['title']} for e in result[:5]]
         except Exception as ex:
             print(f'TRMNL: Calendar fetch error: {ex}')
-            return []
+            self.caldav_calendar_object = None # Find the calendar again next time, in case the session or its URL has gone stale
+            return None
 
     def _extract(self, payload, key):
         val = payload.get(key)
@@ -1308,7 +2406,7 @@ class TrmnlClass(object):
         except Exception:
             return iso_time
 
-    def _build_payload(self, obs, forecast):
+    def _build_payload(self, obs, forecast, cal_events): # Returns the merge variables, and the numbers that stand in for formatted ones in the push hash
         hours = []
         for entry in forecast[:6]:
             chance = entry.get("rain", {}).get("chance", 0)
@@ -1327,8 +2425,10 @@ class TrmnlClass(object):
         front_balcony = enviro_monitor['Front Outdoor'].latest if mgr.enviro_monitors_present else {}
         rear_balcony  = enviro_monitor['Outdoor'].latest       if mgr.enviro_monitors_present else {}
         kitchen       = enviro_monitor['Indoor'].latest        if mgr.enviro_monitors_present else {}
+        rear_balcony_temp_range = mgr.sensor_history.summary('Outdoor', 'Temp', 86400) if mgr.enviro_monitors_present else None
         elec_kw = shelly.total_power / 1000 if mgr.shelly_power_monitor_present else None
         elec_cost_ph = elec_kw * tariff_rate if elec_kw is not None else None
+        elec_cost = energy_cost.summary() if energy_cost is not None else None
         payload = {
             "station": obs.get("station", {}).get("name", "Sydney"),
             "current_temp": obs.get("temp", "–"),
@@ -1350,6 +2450,8 @@ class TrmnlClass(object):
             "rear_balcony_temp": self._extract(rear_balcony, "Temp"),
             "rear_balcony_humidity": self._round0(self._extract(rear_balcony, "Hum")),
             "rear_balcony_dewpoint": self._extract(rear_balcony, "Dew"),
+            "rear_balcony_temp_min_24h": round(rear_balcony_temp_range['Min'], 1) if rear_balcony_temp_range else "–",
+            "rear_balcony_temp_max_24h": round(rear_balcony_temp_range['Max'], 1) if rear_balcony_temp_range else "–",
             "rear_balcony_wind": self._local_wind(),
             "rear_balcony_pm25": self._extract(rear_balcony, "P2.5"),
             "kitchen_temp": self._extract(kitchen, "Temp"),
@@ -1358,26 +2460,86 @@ class TrmnlClass(object):
             "kitchen_pm25": self._extract(kitchen, "P2.5"),
             "electricity_kw": f"{elec_kw:.2f}" if elec_kw is not None else "–",
             "electricity_cost_ph": f"${elec_cost_ph:.2f}/hr" if elec_cost_ph is not None else "–",
+            "electricity_cost_today": f"${elec_cost['Day']['Cost']:.2f}" if elec_cost is not None else "–",
+            "electricity_cost_month": f"${elec_cost['Month']['Cost']:.2f}" if elec_cost is not None else "–",
         }
         for i, h in enumerate(hours):
             payload[f"h{i}_label"] = h["label"]
             payload[f"h{i}_chance"] = h["chance"]
             payload[f"h{i}_amount"] = h["amount"]
             payload[f"h{i}_temp"] = h["temp"]
-        cal_events = self._get_calendar_events()
+        cal_events = list(cal_events)
         while len(cal_events) < 5:
             cal_events.append({'time': '', 'title': ''})
         for idx, ev in enumerate(cal_events):
             payload[f'cal_{idx}_time']  = ev['time']
             payload[f'cal_{idx}_title'] = ev['title']
-        return payload
+        return payload, {'electricity_kw': elec_kw}
+
+    def _timed_fetch(self, source):
+        start_time = time.time()
+        try:
+            return self.sources[source][0]()
+        finally:
+            self.stage_timings[source] = round(time.time() - start_time, 3)
+
+    def _gather(self): # Fetches every source concurrently, under one deadline. Returns source -> data
+        for source in self.sources:
+            future = self.source_futures.get(source)
+            if future is not None and future.done(): # A fetch that finished after an earlier push's deadline still counts as good data
+                self._keep_if_good(source, future)
+            if future is None or future.done():
+                self.source_futures[source] = self.executor.submit(self._timed_fetch, source)
+            else:
+                print('TRMNL:', source, 'fetch is still running from an earlier push')
+        concurrent.futures.wait(self.source_futures.values(), timeout=self.gather_deadline)
+        data = {}
+        for source, future in self.source_futures.items():
+            if not self._keep_if_good(source, future):
+                print('TRMNL:', source, 'missed the deadline or failed. Using its last good data')
+            data[source] = self.last_good[source]
+        return data
+
+    def _keep_if_good(self, source, future): # Stores a finished fetch's result as the source's last good data. Returns whether it did
+        result = future.result() if future.done() and future.exception() is None else None
+        if result is None:
+            return False
+        self.last_good[source] = result
+        return True
+
+    def _quantise(self, key, value): # Rounds value to its push_quantisation step, if key has one
+        for suffix, step in self.push_quantisation.items():
+            if key.endswith(suffix):
+                return round(round(value / step) * step, 6) # The outer round removes float noise such as 0.30000000000000004
+        return value
+
+    def _payload_hash(self, variables, hashed_numbers): # Hash of the fields that count as a material change
+        normalised = {}
+        for key, value in variables.items():
+            if key in self.push_ignored_fields:
+                continue
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                value = self._quantise(key, value)
+            normalised[key] = value
+        for key, value in hashed_numbers.items():
+            normalised[key] = self._quantise(key, value) if value is not None else None
+        return hashlib.sha256(json.dumps(normalised, sort_keys=True, ensure_ascii=True).encode('utf-8')).hexdigest()
 
     def push(self):
-        obs = self._fetch_bom("observations")
-        forecast = self._fetch_bom("forecasts/hourly")
-        variables = self._build_payload(obs, forecast)
+        push_start_time = time.time()
+        data = self._gather()
+        self.stage_timings['Gather'] = round(time.time() - push_start_time, 3)
+        build_start_time = time.time()
+        variables, hashed_numbers = self._build_payload(data['Observations'], data['Forecast'], data['Calendar'])
         variables = {k: v.replace('\u2013', ' -').replace('\u2014', ' -') if isinstance(v, str) else v
                      for k, v in variables.items()}
+        payload_hash = self._payload_hash(variables, hashed_numbers)
+        self.stage_timings['Build'] = round(time.time() - build_start_time, 3)
+        if payload_hash == self.last_push_hash and time.time() - self.last_push_time < self.push_max_age:
+            self.push_counts['Skipped'] += 1
+            print('TRMNL: Nothing has changed. Skipped push', self.push_counts)
+            return
+        post_start_time = time.time()
         url = f"https://trmnl.com/api/custom_plugins/{self.plugin_uuid}"
         try:
             response = requests.post(
@@ -1388,11 +2550,40 @@ class TrmnlClass(object):
                 timeout=30
             )
             print(f"TRMNL: Pushed (HTTP {response.status_code})")
+            if 200 <= response.status_code < 300: # Only a successful push is a baseline for skipping the next one
+                self.last_push_hash = payload_hash
+                self.last_push_time = time.time()
+                self.push_counts['Pushed'] += 1
         except Exception as e:
             import traceback
             traceback.print_exc()
             print("TRMNL: Push error:", e)
+        self.stage_timings['Post'] = round(time.time() - post_start_time, 3)
+        self.stage_timings['Total'] = round(time.time() - push_start_time, 3)
+        print('TRMNL: Stage timings', self.stage_timings, 'BOM Cache', self.bom_cache.get_stats())
                     
+class BlindTriggerQueueClass(object):
+    # Pending triggers for one blind group. Triggers with the same cause are merged, keeping the newest value (so a burst of light
+    # readings collapses to the latest), while different causes are all kept (so a door change and a manual command are both actioned)
+    def __init__(self, blind):
+        self.blind = blind
+        self.lock = threading.Lock()
+        self.pending = OrderedDict() # Cause -> newest value, ordered by most recent arrival
+        self.merged_count = 0
+
+    def post(self, cause, value):
+        with self.lock:
+            if cause in self.pending:
+                self.merged_count += 1
+                self.pending.move_to_end(cause)
+            self.pending[cause] = value
+
+    def take_all(self): # Removes and returns the pending (cause, value) triggers
+        with self.lock:
+            triggers = list(self.pending.items())
+            self.pending.clear()
+        return triggers
+
 class WindowBlindClass(object):
     # Reinstated from Home Manager 14.2. The per-blind Somfy choreography has been collapsed to whole-group
     # positions ('Open'/'Venetian'/'Closed') that are realised through PowerView Gen 2 scenes, while the
@@ -1551,8 +2742,8 @@ class WindowBlindClass(object):
         self.change_blind_position(self._pos_tilt_to_status(self.hk_position, self.hk_tilt))
 
     def change_blind_position(self, blind_position):
-        # Sets the flag that triggers a manual blind change in the main Home Manager loop
-        mgr.call_control_blinds = {'State': True, 'Blind': self.blind, 'Blind_position': blind_position}
+        # Queues the trigger for a manual blind change in the main Home Manager loop
+        mgr.post_blind_trigger(self.blind, 'Manual', blind_position)
 
     def control_blinds(self, blind_position): # Manual whole-group blind control from HomeKit
         mgr.print_update('Invoked Manual Blind Control on ')
@@ -1638,12 +2829,12 @@ class WindowBlindClass(object):
 
 if __name__ == '__main__': # This is where to overall code kicks off
     # Create a Home Manager instance
-    mgr = NorthcliffHomeManagerClass(key_state_log_file_name='<Your Key State Log File Path and Name>', watchdog_file_name='<Your Watchdog File Path and Name>', luftdaten_sensor_id='<Your Luftdaten Sensor ID>')
+    mgr = NorthcliffHomeManagerClass(key_state_log_file_name='<Your Key State Log File Path and Name>', watchdog_file_name='<Your Watchdog File Path and Name>', luftdaten_sensor_ids=['<Your Luftdaten Sensor ID>'])
     # Create a Homebridge instance
     homebridge = HomebridgeClass(mgr.outdoor_multisensor_names, mgr.outdoor_sensors_homebridge_name, mgr.door_sensor_names_locations, mgr.enviro_config,
                                  mgr.window_blind_threshold_1, mgr.window_blind_threshold_2, mgr.previous_window_blind_state)
     # Create a Domoticz instance
-    domoticz = DomoticzClass()
+    domoticz = DomoticzClass(mgr.domoticz_send_policies)
     if mgr.multisensors_present:
         # Use a dictionary comprehension to create a multisensor instance for each multisensor
         multisensor = {name: MultisensorClass(name) for name in mgr.multisensor_names}
@@ -1656,6 +2847,8 @@ if __name__ == '__main__': # This is where to overall code kicks off
     if mgr.flood_sensors_present:
         # Use a dictionary comprehension to create a flood sensor instance for each flood sensor
         flood_sensor = {name: FloodSensorClass(name) for name in mgr.flood_sensor_names}
+    # Index the Domoticz devices that have sensor objects
+    domoticz.build_device_index()
     if mgr.garage_door_present:
         # Create a Garage Door Controller instance
         garage_door = GaragedoorClass()
@@ -1675,7 +2868,16 @@ if __name__ == '__main__': # This is where to overall code kicks off
                            peak_hours = {1: (14, 20), 2: (14, 20), 3: (14, 20), 4: None, 5: None, 6: (17, 21), 7: (17, 21), 8: (17, 21), 9: None,
                                          10: (14, 17), 11: (14, 20), 12: (17, 20)},
                            tariff_rates = {"Off Peak": 0.16588, "Shoulder": 0.28435, "Peak": 0.538516},
-                           location = LocationInfo("<Your City>", "<Your Country>", "<Your Timezone e.g. Australia/Sydney>", "<Your Latitude>", "<Your Longitude>"))
+                           location = LocationInfo("<Your City>", "<Your Country>", "<Your Timezone e.g. Australia/Sydney>", "<Your Latitude>", "<Your Longitude>"),
+                           bom_cache_file_name='<Your BOM Cache File Path and Name>')
+    if mgr.shelly_power_monitor_present and mgr.trmnl_present:
+        # Cost the Shelly energy readings against the TRMNL tariff
+        energy_cost = EnergyCostClass(trmnl._tariff_name, trmnl.tariff_rates)
+    else:
+        energy_cost = None
+    # Create the worker lanes that handle incoming mqtt messages
+    pipeline = MessagePipelineClass(mgr.message_lanes, mgr.message_queue_bound, mgr.lossless_message_lanes)
+    pipeline.start()
     # Create and set up an mqtt instance                             
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, 'home_manager')
     client.on_connect = mgr.on_connect
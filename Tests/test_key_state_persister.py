@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#Tests of KeyStatePersisterClass journal recovery. Run from the repository root with the Home Manager's dependencies installed:
+#python -m unittest discover Tests
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Northcliff_Home_Manager_Gen as home_manager
+
+class KeyStatePersisterTornTailTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'key_state.json')
+        with open(self.file_name, 'w') as f:
+            f.write(json.dumps({'Reason': 'Snapshot', 'Door State': {'Entry': False}}))
+        self.state = {'Door State': {'Entry': True}}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def persister(self):
+        return home_manager.KeyStatePersisterClass(self.file_name, 60, lambda reason: dict(self.state, Reason=reason))
+
+    def test_append_after_torn_tail_is_replayed(self):
+        persister = self.persister()
+        persister.load()
+        persister.mark_dirty('Door Opened')
+        persister.flush()
+        with open(self.file_name + '.journal', 'a') as f: # A crash mid-append
+            f.write('{"Time": 1, "Reason": "Door Closed", "Key": "Door')
+        persister = self.persister() # Restart
+        self.assertEqual(persister.load()['Door State']['Entry'], True)
+        self.state['Door State']['Entry'] = False
+        persister.mark_dirty('Door Closed')
+        persister.flush()
+        self.assertEqual(self.persister().load()['Door State']['Entry'], False)
+        with open(self.file_name + '.journal', 'r') as f:
+            for line in f:
+                json.loads(line) # Every journal line reads back
+
+class KeyStatePersisterRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'key_state.json')
+        self.failures = 1
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build_state(self, reason):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('deque mutated during iteration')
+        return {'Reason': reason, 'Door State': {'Entry': True}}
+
+    def test_failed_flush_is_retried(self):
+        persister = home_manager.KeyStatePersisterClass(self.file_name, 60, self.build_state)
+        persister.load()
+        persister.mark_dirty('Door Opened')
+        persister.flush()
+        self.assertEqual(persister.dirty_reasons, ['Door Opened'])
+        self.assertIsNotNone(persister.timer)
+        persister.flush()
+        self.assertIsNone(persister.timer)
+        state = home_manager.KeyStatePersisterClass(self.file_name, 60, None).load()
+        self.assertEqual(state['Door State']['Entry'], True)
+        self.assertEqual(state['Reason'], 'Door Opened')
+
+if __name__ == '__main__':
+    unittest.main()